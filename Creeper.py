@@ -10,36 +10,264 @@ Please note that this program is only for scientific research and learning purpo
 The author shall not be held legally responsible for any consequences resulting from improper use of the program.
 
 Function Table:
-DownloadImage(URL: str, SavePath: str, MaxRetries: int = 3) -> bool -- Download images with retry mechanism
+CreateSession(PoolSize: int = 16) -> requests.Session -- Create a keep-alive session with a connection pool
+DownloadImage(URL: str, SavePath: str, MaxRetries: int = 3, Session: requests.Session = None,
+              Stream: bool = False, ChunkSize: int = 65536, MaxSize: int = None,
+              Index: DownloadIndex = None, Revalidate: bool = True, Resume: bool = True) -> bool 
+-- Download images with retry mechanism, optionally streaming the body to disk in chunks
+DownloadImages(URLs: list, SaveDir: str, Concurrency: int = 16, MaxRetries: int = 3,
+               Stream: bool = False, ChunkSize: int = 65536, MaxSize: int = None,
+               Index: DownloadIndex = None, Revalidate: bool = True,
+               SavePaths: list = None, OnResult = None) -> list
+-- Concurrently download a batch of images over one pooled session
+AsyncDownloadImages(URLs: list, SaveDir: str, Concurrency: int = 256, HostConcurrency: int = 8,
+                    HostRate: float = None, MaxRetries: int = 3, ChunkSize: int = 65536, MaxSize: int = None) -> list
+-- Download a batch of images on one event loop with per-host concurrency caps and rate limits
+CreateJob(URLs: list, SaveDir: str, JobPath: str, Concurrency: int = 16, MaxRetries: int = 3,
+          Stream: bool = False, MaxSize: int = None, IndexPath: str = None) -> None
+-- Write the manifest of a download job to its journal
+ResumeJob(JobPath: str, MaxAttempts: int = None) -> list
+-- Download the unfinished URLs of a job and journal the result of each URL
+RunJob(URLs: list, SaveDir: str, JobPath: str, **Options) -> list
+-- Create the job if its journal does not exist, then run it until all URLs are processed
 '''
 
 import os
 import time
 import random
+import asyncio
+import re
+import json
+import hashlib
 import requests
 
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+from tqdm import tqdm
+
 from FileProcess import LogMessage
+from DownloadCache import DownloadIndex
+
+# Create a keep-alive session with a connection pool
+# Reusing one session lets every request to the same host share TCP/TLS connections,
+# instead of paying a new handshake for each image.
+# PoolSize should be no less than the number of threads using the session.
+def CreateSession(PoolSize: int = 16) -> requests.Session:
+    Session = requests.Session()
+    Adapter = HTTPAdapter(pool_connections=PoolSize, pool_maxsize=PoolSize)
+    Session.mount("http://", Adapter)
+    Session.mount("https://", Adapter)
+
+    return Session
+
+# Write the response body to a temporary file chunk by chunk, then rename it to SavePath
+# In this way, the whole body never stays in memory, and a broken transfer never leaves a truncated image.
+# If Offset is not zero, the response should be a 206 partial response starting at Offset,
+# and its body will be appended to the existing temporary file.
+# The received bytes will be checked against Content-Range / Content-Length before renaming.
+# If KeepPartial is True, the temporary file will be kept on network errors, so that the transfer can be resumed.
+# Return False if the body exceeds MaxSize. Network errors and incomplete bodies will be raised to the caller.
+def SaveResponseStream(Response: requests.Response, SavePath: str, ChunkSize: int = 65536, MaxSize: int = None,
+                       Offset: int = 0, KeepPartial: bool = False) -> bool:
+    TempPath = SavePath + ".part"
+
+    # Determine the expected size of the whole image
+    Expected = None
+    ContentLength = Response.headers.get("Content-Length")
+    if Offset:
+        # Content-Range: bytes {Start}-{End}/{Total}
+        ContentRange = Response.headers.get("Content-Range", "")
+        Match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", ContentRange)
+        if not Match or int(Match.group(1)) != Offset:
+            # The partial file cannot be continued, start over next time
+            if os.path.exists(TempPath):
+                os.remove(TempPath)
+            raise requests.exceptions.RequestException(f"Unexpected Content-Range '{ContentRange}' for offset {Offset}")
+
+        if Match.group(3) != "*":
+            Expected = int(Match.group(3))
+        elif ContentLength and ContentLength.isdigit():
+            Expected = Offset + int(ContentLength)
+
+    # The declared length only matches the written bytes when the body is not encoded
+    elif ContentLength and ContentLength.isdigit() and Response.headers.get("Content-Encoding", "identity") == "identity":
+        Expected = int(ContentLength)
+
+    # Reject the oversized body in advance if the server declares its length
+    if MaxSize and Expected and Expected > MaxSize:
+        LogMessage(f"Image size {Expected} bytes exceeds the limit {MaxSize} bytes: {Response.url}", 'WARNING')
+        if os.path.exists(TempPath):
+            os.remove(TempPath)
+        return False
+
+    try:
+        Received = Offset
+        with open(TempPath, 'ab' if Offset else 'wb') as f:
+            for Chunk in Response.iter_content(chunk_size=ChunkSize):
+                Received += len(Chunk)
+                # The declared length may be absent or wrong, so we check the received bytes as well
+                if MaxSize and Received > MaxSize:
+                    LogMessage(f"Image size exceeds the limit {MaxSize} bytes: {Response.url}", 'WARNING')
+                    break
+                f.write(Chunk)
+
+        if MaxSize and Received > MaxSize:
+            os.remove(TempPath)
+            return False
+
+        # The connection may be closed before the whole body arrives
+        if Expected is not None and Received != Expected:
+            # More bytes than expected means the partial file is broken, it cannot be resumed
+            if Received > Expected:
+                os.remove(TempPath)
+            raise requests.exceptions.RequestException(f"Incomplete body, received {Received} of {Expected} bytes")
+
+        # Atomic replacement on the same file system
+        os.replace(TempPath, SavePath)
+        return True
+
+    except BaseException:
+        # Remove the incomplete file before the error goes up, unless we want to resume it
+        if not KeepPartial and os.path.exists(TempPath):
+            os.remove(TempPath)
+        raise
+
+# Read the validator of a partial file, or None if it is unknown
+def ReadPartValidator(TempPath: str) -> str:
+    try:
+        with open(TempPath + ".validator", 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+# Keep the validator of a partial file beside it, or remove it if Validator is None
+# Return the validator for convenience.
+def WritePartValidator(TempPath: str, Validator: str = None) -> str:
+    ValidatorPath = TempPath + ".validator"
+    if Validator:
+        with open(ValidatorPath, 'w', encoding='utf-8') as f:
+            f.write(Validator)
+    elif os.path.exists(ValidatorPath):
+        os.remove(ValidatorPath)
+
+    return Validator
 
 # Download images
-def DownloadImage(URL: str, SavePath: str, MaxRetries: int = 3) -> bool:
+# If a session is provided, the request will reuse its pooled connections
+# If Stream is True, the body will be written in chunks of ChunkSize bytes through a temporary file,
+# and images larger than MaxSize bytes will be discarded without retrying.
+# Thus the peak memory is bounded by ChunkSize times the number of concurrent downloads.
+# If a download index is provided, a known URL will be revalidated by a conditional request,
+# or skipped directly if Revalidate is False. A 304 response reuses the file recorded in the index.
+# Every new download is recorded in the index, and duplicated content is hard linked (see DownloadCache.py).
+# If Resume is True in the streaming mode, the partial file of a broken transfer will be kept,
+# and the next attempt only asks for the missing bytes by a Range request.
+# If the server ignores the range, the image will be downloaded from the beginning.
+# The validator (ETag / Last-Modified) of the response that started the partial file is kept in a ".validator" file
+# beside it, so that a later call can still send If-Range. A partial file without a known validator is discarded,
+# since the image may have changed on the server while keeping its length.
+def DownloadImage(URL: str, SavePath: str, MaxRetries: int = 3, Session: requests.Session = None,
+                  Stream: bool = False, ChunkSize: int = 65536, MaxSize: int = None,
+                  Index: DownloadIndex = None, Revalidate: bool = True, Resume: bool = True) -> bool:
+    # Fall back to the module level API, which opens a new connection for each call
+    Requester = Session if Session is not None else requests
+
+    # Consult the download index before sending any request
+    Headers = {}
+    if Index is not None:
+        if not Revalidate and Index.LinkKnown(URL, SavePath):
+            LogMessage(f"Skip known image from {URL}, saved to {SavePath}.")
+            return True
+        Headers = Index.ConditionalHeaders(URL)
+
+    TempPath = SavePath + ".part"
+    # The validator of the response that started the partial file, so that the server can tell us if it has changed
+    PartValidator = ReadPartValidator(TempPath)
+
     for Attempt in range(1, MaxRetries + 1):
         try:
+            RequestHeaders = dict(Headers)
+            Offset = 0
+            if Stream and Resume:
+                # Byte ranges only make sense on the raw body
+                RequestHeaders["Accept-Encoding"] = "identity"
+                if os.path.exists(TempPath) and not PartValidator:
+                    LogMessage(f"Discard partial file without validator: {TempPath}", 'WARNING')
+                    os.remove(TempPath)
+                if os.path.exists(TempPath) and os.path.getsize(TempPath) > 0:
+                    Offset = os.path.getsize(TempPath)
+                    # A partial file cannot be revalidated, ask for the missing bytes instead
+                    RequestHeaders.pop("If-None-Match", None)
+                    RequestHeaders.pop("If-Modified-Since", None)
+                    RequestHeaders["Range"] = f"bytes={Offset}-"
+                    RequestHeaders["If-Range"] = PartValidator
+
             # Header information can be added here to simulate browser behavior
-            Response = requests.get(URL, timeout=10)
+            Response = Requester.get(URL, timeout=10, stream=Stream, headers=RequestHeaders)
+
+            # The partial file is no longer valid for the image on the server
+            if Offset and Response.status_code == 416:
+                Response.close()
+                os.remove(TempPath)
+                PartValidator = WritePartValidator(TempPath, None)
+                LogMessage(f"Range not satisfiable for {URL}, restart from the beginning (Attempt {Attempt}/{MaxRetries})", 'WARNING')
+                continue
 
             # Download successful
-            if Response.status_code == 200:
+            if Response.status_code == 200 or (Offset and Response.status_code == 206):
                 # Ensure the directory exists before saving the file
                 os.makedirs(os.path.dirname(SavePath), exist_ok=True)
-                
-                with open(SavePath, 'wb') as f:
-                    f.write(Response.content)
+
+                if Stream:
+                    # The server ignores the range and sends the whole image
+                    if Response.status_code == 200:
+                        if Offset:
+                            LogMessage(f"Server ignores the range request for {URL}, download from the beginning.", 'WARNING')
+                        Offset = 0
+                        # Weak ETags cannot be used in If-Range, use Last-Modified instead
+                        ETag = Response.headers.get("ETag")
+                        Validator = ETag if ETag and not ETag.startswith("W/") else Response.headers.get("Last-Modified")
+                        PartValidator = WritePartValidator(TempPath, Validator if Resume else None)
+
+                    # The connection will be released back to the pool when the response is closed
+                    with Response:
+                        if not SaveResponseStream(Response, SavePath, ChunkSize, MaxSize, Offset, KeepPartial=Resume):
+                            WritePartValidator(TempPath, None)
+                            # Retrying cannot make an oversized image smaller
+                            return False
+                    # The partial file has become the image
+                    WritePartValidator(TempPath, None)
                     LogMessage(f"Image saved to {SavePath} successfully.")
+
+                else:
+                    # The file may be a hard link shared with other images, never overwrite it in place
+                    if os.path.exists(SavePath) and os.stat(SavePath).st_nlink > 1:
+                        os.remove(SavePath)
+
+                    with open(SavePath, 'wb') as f:
+                        f.write(Response.content)
+                        LogMessage(f"Image saved to {SavePath} successfully.")
+
+                # Record the download for later runs
+                if Index is not None:
+                    Index.Record(URL, SavePath, Response.headers)
                     
                 return True
+
+            # The image has not been modified since the last download
+            elif Response.status_code == 304 and Index is not None and Index.LinkKnown(URL, SavePath):
+                Response.close()
+                LogMessage(f"Image from {URL} not modified, saved to {SavePath}.")
+                return True
             
             # Download failed
             else:
+                Response.close()
+
                 # Output error log
                 ERROR_MSG = f"Failed to download image from {URL}, status code: {Response.status_code} (Attempt {Attempt}/{MaxRetries})"
                 LogMessage(ERROR_MSG, 'WARNING')
@@ -68,4 +296,369 @@ def DownloadImage(URL: str, SavePath: str, MaxRetries: int = 3) -> bool:
     FINAL_ERROR_MSG = f"Failed to download image from {URL} after {MaxRetries} attempts"
     LogMessage(FINAL_ERROR_MSG, 'ERROR')
 
-    return False
\ No newline at end of file
+    return False
+
+# Generate a file name for the image according to its URL
+# If the URL does not end with a file name, the hash of the URL will be used instead
+def GetImageName(URL: str) -> str:
+    ImageName = os.path.basename(urlparse(URL).path)
+    if not ImageName:
+        ImageName = hashlib.sha1(URL.encode("utf-8")).hexdigest()[:16] + ".jpg"
+
+    return ImageName
+
+# Determine the save path in SaveDir for each URL
+# If two URLs lead to the same name, the later one will be prefixed with the hash of its URL.
+def AssignSavePaths(URLs: list, SaveDir: str) -> list:
+    SavePaths = []
+    UsedNames = set()
+    for URL in URLs:
+        ImageName = GetImageName(URL)
+        if ImageName in UsedNames:
+            ImageName = hashlib.sha1(URL.encode("utf-8")).hexdigest()[:8] + "-" + ImageName
+        UsedNames.add(ImageName)
+        SavePaths.append(os.path.join(SaveDir, ImageName))
+
+    return SavePaths
+
+# Concurrently download a batch of images
+# All workers share one pooled keep-alive session, so connections are reused across images.
+# The images will be saved to SaveDir with the names derived from their URLs (see AssignSavePaths).
+# The returned list keeps the order of URLs, and each item records the status of one URL:
+# {"URL": URL, "SavePath": SavePath, "Success": bool}
+# Stream, ChunkSize, MaxSize, Index and Revalidate are passed to DownloadImage for each URL.
+# SavePaths can be given explicitly to override the names derived from the URLs.
+# OnResult, if provided, is called with each status item as soon as the URL finishes.
+def DownloadImages(URLs: list, SaveDir: str, Concurrency: int = 16, MaxRetries: int = 3,
+                   Stream: bool = False, ChunkSize: int = 65536, MaxSize: int = None,
+                   Index: DownloadIndex = None, Revalidate: bool = True,
+                   SavePaths: list = None, OnResult = None) -> list:
+    # Determine the save path for each URL in advance
+    if SavePaths is None:
+        SavePaths = AssignSavePaths(URLs, SaveDir)
+
+    Results = [{"URL": URL, "SavePath": SavePath, "Success": False} for URL, SavePath in zip(URLs, SavePaths)]
+    if not URLs:
+        return Results
+
+    Session = CreateSession(PoolSize=Concurrency)
+    StartTime = time.time()
+
+    try:
+        with ThreadPoolExecutor(max_workers=Concurrency) as Executor:
+            FutureToIdx = {}
+            # Submit tasks to the executor
+            for idx, (URL, SavePath) in enumerate(zip(URLs, SavePaths)):
+                Future = Executor.submit(DownloadImage, URL, SavePath, MaxRetries, Session,
+                                         Stream, ChunkSize, MaxSize, Index, Revalidate)
+                FutureToIdx[Future] = idx
+
+            # Process completed futures
+            for Future in tqdm(as_completed(FutureToIdx.keys()), total=len(FutureToIdx), desc="Downloading"):
+                idx = FutureToIdx[Future]
+                try:
+                    Results[idx]["Success"] = Future.result()
+                except Exception as e:
+                    LogMessage(f"Unexpected error while downloading image from {URLs[idx]}: {str(e)}", 'ERROR')
+
+                if OnResult is not None:
+                    OnResult(Results[idx])
+
+    finally:
+        Session.close()
+
+    # Summarize the throughput of this batch
+    Elapsed = max(time.time() - StartTime, 1e-6)
+    SuccessCount = sum(1 for Result in Results if Result["Success"])
+    LogMessage(f"Downloaded {SuccessCount}/{len(URLs)} images in {Elapsed:.2f}s ({SuccessCount / Elapsed:.2f} images/s)")
+
+    return Results
+
+# Concurrency cap and token bucket rate limit for one host
+# Rate is the number of requests allowed per second, and Burst is the capacity of the bucket.
+# If Rate is None, only the concurrency cap takes effect.
+class HostLimiter:
+    def __init__(self, Concurrency: int = 8, Rate: float = None, Burst: float = None):
+        self.Semaphore = asyncio.Semaphore(Concurrency)
+        self.Rate = Rate
+        self.Capacity = Burst if Burst else max(1.0, Rate or 1.0)
+        self.Tokens = self.Capacity
+        self.LastTime = time.monotonic()
+        # Serialize the waiters so that the tokens are handed out in order
+        self.Lock = asyncio.Lock()
+
+    # Occupy a connection slot of the host and consume one token
+    async def Acquire(self):
+        await self.Semaphore.acquire()
+        if not self.Rate:
+            return
+
+        async with self.Lock:
+            while True:
+                # Refill the bucket according to the elapsed time
+                Now = time.monotonic()
+                self.Tokens = min(self.Capacity, self.Tokens + (Now - self.LastTime) * self.Rate)
+                self.LastTime = Now
+
+                if self.Tokens >= 1:
+                    self.Tokens -= 1
+                    return
+
+                # Sleep until the next token is available, without blocking other hosts
+                await asyncio.sleep((1 - self.Tokens) / self.Rate)
+
+    # Give back the connection slot of the host
+    def Release(self):
+        self.Semaphore.release()
+
+# Download one image on the event loop
+# The body is always streamed to a temporary file and renamed on success, just like DownloadImage with Stream=True.
+# The host slot is released during the retry backoff, so a failing host does not hold its slots while waiting.
+async def AsyncDownloadImage(Session: "aiohttp.ClientSession", URL: str, SavePath: str, Limiter: HostLimiter,
+                             MaxRetries: int = 3, ChunkSize: int = 65536, MaxSize: int = None) -> bool:
+    import aiohttp
+
+    TempPath = SavePath + ".part"
+
+    for Attempt in range(1, MaxRetries + 1):
+        await Limiter.Acquire()
+        try:
+            async with Session.get(URL) as Response:
+                # Download successful
+                if Response.status == 200:
+                    # Reject the oversized body in advance if the server declares its length
+                    if MaxSize and Response.content_length and Response.content_length > MaxSize:
+                        LogMessage(f"Image size {Response.content_length} bytes exceeds the limit {MaxSize} bytes: {URL}", 'WARNING')
+                        return False
+
+                    # Ensure the directory exists before saving the file
+                    os.makedirs(os.path.dirname(SavePath), exist_ok=True)
+
+                    Received = 0
+                    with open(TempPath, 'wb') as f:
+                        async for Chunk in Response.content.iter_chunked(ChunkSize):
+                            Received += len(Chunk)
+                            if MaxSize and Received > MaxSize:
+                                break
+                            f.write(Chunk)
+
+                    if MaxSize and Received > MaxSize:
+                        os.remove(TempPath)
+                        LogMessage(f"Image size exceeds the limit {MaxSize} bytes: {URL}", 'WARNING')
+                        return False
+
+                    os.replace(TempPath, SavePath)
+                    LogMessage(f"Image saved to {SavePath} successfully.")
+                    return True
+
+                # Download failed
+                else:
+                    ERROR_MSG = f"Failed to download image from {URL}, status code: {Response.status} (Attempt {Attempt}/{MaxRetries})"
+                    LogMessage(ERROR_MSG, 'WARNING')
+
+        except asyncio.TimeoutError:
+            ERROR_MSG = f"Timeout while downloading image from {URL} (Attempt {Attempt}/{MaxRetries})"
+            LogMessage(ERROR_MSG, 'WARNING')
+
+        except aiohttp.ClientError as e:
+            ERROR_MSG = f"Network error while downloading image from {URL}: {str(e)} (Attempt {Attempt}/{MaxRetries})"
+            LogMessage(ERROR_MSG, 'WARNING')
+
+        finally:
+            Limiter.Release()
+            # Never leave a truncated image behind
+            if os.path.exists(TempPath):
+                os.remove(TempPath)
+
+        # Wait before retrying, other downloads keep running in the meantime
+        if Attempt < MaxRetries:
+            await asyncio.sleep(random.uniform(2, 4))
+
+    # All retries failed
+    FINAL_ERROR_MSG = f"Failed to download image from {URL} after {MaxRetries} attempts"
+    LogMessage(FINAL_ERROR_MSG, 'ERROR')
+
+    return False
+
+# Download a batch of images with asyncio
+# Thousands of requests can be kept in flight on a single thread, while each host gets its own limiter:
+# at most HostConcurrency connections and HostRate requests per second (HostBurst requests at once).
+# Concurrency is the cap on the total number of open connections.
+# The returned list has the same format and order as DownloadImages.
+# Since this is a coroutine, it should be called like: asyncio.run(AsyncDownloadImages(URLs, SaveDir))
+# aiohttp is an optional dependency, which is only imported when the async downloads are used.
+async def AsyncDownloadImages(URLs: list, SaveDir: str, Concurrency: int = 256, HostConcurrency: int = 8,
+                              HostRate: float = None, HostBurst: float = None, MaxRetries: int = 3,
+                              ChunkSize: int = 65536, MaxSize: int = None) -> list:
+    import aiohttp
+
+    SavePaths = AssignSavePaths(URLs, SaveDir)
+    Results = [{"URL": URL, "SavePath": SavePath, "Success": False} for URL, SavePath in zip(URLs, SavePaths)]
+    if not URLs:
+        return Results
+
+    # Create the limiters lazily, one for each host
+    Limiters = {}
+    def GetLimiter(URL: str) -> HostLimiter:
+        Host = urlparse(URL).netloc
+        if Host not in Limiters:
+            Limiters[Host] = HostLimiter(HostConcurrency, HostRate, HostBurst)
+        return Limiters[Host]
+
+    # Keep the same timeout as the synchronous version
+    Timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    Connector = aiohttp.TCPConnector(limit=Concurrency, limit_per_host=HostConcurrency)
+    StartTime = time.time()
+
+    async with aiohttp.ClientSession(timeout=Timeout, connector=Connector) as Session:
+        async def Worker(idx: int) -> int:
+            try:
+                Results[idx]["Success"] = await AsyncDownloadImage(Session, URLs[idx], SavePaths[idx], GetLimiter(URLs[idx]),
+                                                                   MaxRetries, ChunkSize, MaxSize)
+            except Exception as e:
+                LogMessage(f"Unexpected error while downloading image from {URLs[idx]}: {str(e)}", 'ERROR')
+            return idx
+
+        Tasks = [asyncio.ensure_future(Worker(idx)) for idx in range(len(URLs))]
+        for Task in tqdm(asyncio.as_completed(Tasks), total=len(Tasks), desc="Downloading"):
+            await Task
+
+    # Summarize the throughput of this batch
+    Elapsed = max(time.time() - StartTime, 1e-6)
+    SuccessCount = sum(1 for Result in Results if Result["Success"])
+    LogMessage(f"Downloaded {SuccessCount}/{len(URLs)} images in {Elapsed:.2f}s ({SuccessCount / Elapsed:.2f} images/s)")
+
+    return Results
+
+# A download job is described by an append-only JSONL journal.
+# The first line is the manifest that keeps the options of the job:
+# {"Type": "Manifest", "SaveDir": ..., "Concurrency": ..., "MaxRetries": ..., "Stream": ..., "MaxSize": ..., "IndexPath": ...}
+# Then each URL is queued by one line: {"Type": "Queued", "URL": ..., "SavePath": ...}
+# And each finished URL appends one line: {"Type": "Done" / "Failed", "URL": ..., "SavePath": ..., "Attempts": ...}
+# The states are keyed by SavePath, which is unique in a job even when the same URL is queued twice.
+# The last state of a SavePath wins, so replaying the journal tells exactly where the crawl stopped.
+
+# Write the manifest of a download job to its journal
+def CreateJob(URLs: list, SaveDir: str, JobPath: str, Concurrency: int = 16, MaxRetries: int = 3,
+              Stream: bool = False, MaxSize: int = None, IndexPath: str = None) -> None:
+    if os.path.exists(JobPath):
+        LogMessage(f"Job journal already exists: {JobPath}", 'ERROR')
+        return
+
+    Manifest = {
+        "Type": "Manifest", "SaveDir": SaveDir, "Concurrency": Concurrency, "MaxRetries": MaxRetries,
+        "Stream": Stream, "MaxSize": MaxSize, "IndexPath": IndexPath
+    }
+
+    # A URL queued twice would be downloaded twice for nothing, so only its first occurrence is kept
+    UniqueURLs = list(dict.fromkeys(URLs))
+    if len(UniqueURLs) < len(URLs):
+        LogMessage(f"Skip {len(URLs) - len(UniqueURLs)} duplicate URLs in job: {JobPath}", 'WARNING')
+    URLs = UniqueURLs
+
+    # Write the whole manifest to a temporary file first, so a crash here never leaves half a job
+    TempPath = JobPath + ".part"
+    with open(TempPath, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(Manifest, ensure_ascii=False) + '\n')
+        for URL, SavePath in zip(URLs, AssignSavePaths(URLs, SaveDir)):
+            f.write(json.dumps({"Type": "Queued", "URL": URL, "SavePath": SavePath}, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(TempPath, JobPath)
+
+    LogMessage(f"Job with {len(URLs)} URLs created: {JobPath}")
+
+# Replay the journal of a job
+# Return the manifest and the state of each queued item in the queued order:
+# {SavePath: {"URL": URL, "SavePath": SavePath, "Status": "Queued" / "Done" / "Failed", "Attempts": int}}
+# The results written by older versions have no SavePath, and they are applied to every item of their URL.
+def ReadJob(JobPath: str) -> tuple:
+    Manifest = None
+    States = {}
+    URLToPaths = {}
+
+    with open(JobPath, 'r', encoding='utf-8') as f:
+        for Line in f:
+            try:
+                Record = json.loads(Line)
+            except json.JSONDecodeError:
+                # The last line may be incomplete if the process was killed while writing it
+                LogMessage(f"Skip broken line in job journal {JobPath}: {Line.strip()}", 'WARNING')
+                continue
+
+            if Record["Type"] == "Manifest":
+                Manifest = Record
+            elif Record["Type"] == "Queued":
+                States[Record["SavePath"]] = {"URL": Record["URL"], "SavePath": Record["SavePath"], "Status": "Queued", "Attempts": 0}
+                URLToPaths.setdefault(Record["URL"], []).append(Record["SavePath"])
+            else:
+                SavePaths = [Record["SavePath"]] if "SavePath" in Record else URLToPaths.get(Record["URL"], [])
+                for SavePath in SavePaths:
+                    if SavePath in States:
+                        States[SavePath]["Status"] = Record["Type"]
+                        States[SavePath]["Attempts"] = Record["Attempts"]
+
+    return Manifest, States
+
+# Append a newline to the journal if its last line is not complete
+def EndJournalLine(JobPath: str):
+    with open(JobPath, 'rb+') as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+# Download the unfinished URLs of a job
+# The URLs that are queued or failed will be downloaded again, unless they have failed MaxAttempts times.
+# The result of each URL is appended to the journal as soon as it finishes,
+# so the job can be resumed again after another crash without losing any finished work.
+# Return the final state of all URLs in the job.
+def ResumeJob(JobPath: str, MaxAttempts: int = None) -> list:
+    if not os.path.exists(JobPath):
+        LogMessage(f"Job journal not found: {JobPath}", 'ERROR')
+        return []
+
+    Manifest, States = ReadJob(JobPath)
+    if Manifest is None:
+        LogMessage(f"Job journal has no manifest: {JobPath}", 'ERROR')
+        return []
+
+    Pending = [State for State in States.values()
+               if State["Status"] != "Done" and (MaxAttempts is None or State["Attempts"] < MaxAttempts)]
+    LogMessage(f"Resume job {JobPath}: {len(States) - len(Pending)}/{len(States)} URLs need no download")
+
+    if Pending:
+        Index = DownloadIndex(Manifest["IndexPath"]) if Manifest.get("IndexPath") else None
+        # End the broken last line left by a crash, so that the new records start on their own lines
+        EndJournalLine(JobPath)
+
+        with open(JobPath, 'a', encoding='utf-8') as Journal:
+            # Journal each finished URL immediately
+            def OnResult(Result: dict):
+                State = States[Result["SavePath"]]
+                State["Status"] = "Done" if Result["Success"] else "Failed"
+                State["Attempts"] += 1
+                Journal.write(json.dumps({"Type": State["Status"], "URL": State["URL"], "SavePath": State["SavePath"],
+                                          "Attempts": State["Attempts"]}, ensure_ascii=False) + '\n')
+                Journal.flush()
+
+            try:
+                DownloadImages(
+                    [State["URL"] for State in Pending], Manifest["SaveDir"],
+                    Concurrency=Manifest["Concurrency"], MaxRetries=Manifest["MaxRetries"],
+                    Stream=Manifest["Stream"], MaxSize=Manifest["MaxSize"], Index=Index,
+                    SavePaths=[State["SavePath"] for State in Pending], OnResult=OnResult
+                )
+            finally:
+                if Index is not None:
+                    Index.Close()
+
+    return list(States.values())
+
+# Create the job if its journal does not exist, then run it
+# The options are the same as CreateJob, and they are ignored when the journal already exists.
+def RunJob(URLs: list, SaveDir: str, JobPath: str, **Options) -> list:
+    if not os.path.exists(JobPath):
+        CreateJob(URLs, SaveDir, JobPath, **Options)
+
+    return ResumeJob(JobPath)
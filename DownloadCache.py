@@ -0,0 +1,200 @@
+'''
+Copyright(c) Liang Yiyan, Pekin University, 2026. All rights reserved.
+
+This program keeps a persistent index of the downloaded images in a SQLite database.
+For each URL, we record where it was saved, the validators returned by the server (ETag / Last-Modified),
+the size, the mtime and the SHA-256 hash of the content.
+With this index, a re-run of the crawler can skip known URLs or send conditional requests,
+and byte-identical images coming from different URLs will be stored only once by hard links.
+
+Function Table:
+ComputeFileHash(FilePath: str, ChunkSize: int = 1048576) -> str -- Compute the SHA-256 hash of a file
+FileMatches(FilePath: str, Size: int, Hash: str, MTime: int = None) -> bool
+-- Check whether a file still has the given size and hash, trusting an unchanged mtime
+LinkFile(SourcePath: str, DestPath: str) -> None -- Replace a file with a hard link to another file
+DownloadIndex(IndexPath: str = INDEX_FILE) -- Initialize the download index
+DownloadIndex.Lookup(URL: str) -> dict -- Get the record of a URL
+DownloadIndex.KnownPath(URL: str) -> str -- Get the saved path of a URL if the file still holds its content
+DownloadIndex.ConditionalHeaders(URL: str) -> dict -- Build the headers for a conditional request
+DownloadIndex.LinkKnown(URL: str, SavePath: str) -> bool -- Make the known content of a URL available at SavePath
+DownloadIndex.Record(URL: str, SavePath: str, Headers: dict = None) -> str -- Record a finished download and deduplicate it
+'''
+
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+from FileProcess import LogMessage
+
+# The default database file of the download index
+INDEX_FILE = "DownloadIndex.db"
+
+# Compute the SHA-256 hash of a file
+def ComputeFileHash(FilePath: str, ChunkSize: int = 1048576) -> str:
+    Hasher = hashlib.sha256()
+    with open(FilePath, "rb") as f:
+        for Chunk in iter(lambda: f.read(ChunkSize), b""):
+            Hasher.update(Chunk)
+
+    return Hasher.hexdigest()
+
+# Check whether a file still exists with the given size and SHA-256 hash
+# The size is compared first, so most of the changed files are found without reading them.
+# If the mtime in nanoseconds is given and unchanged, the file is trusted without being hashed,
+# so a re-crawl does not read every known image again.
+def FileMatches(FilePath: str, Size: int, Hash: str, MTime: int = None) -> bool:
+    try:
+        Stat = os.stat(FilePath)
+    except OSError:
+        return False
+
+    if Stat.st_size != Size:
+        return False
+    if Hash is None or (MTime is not None and Stat.st_mtime_ns == MTime):
+        return True
+
+    return ComputeFileHash(FilePath) == Hash
+
+# Persistent index of downloaded images
+# The index can be shared by the threads of DownloadImages, since all accesses are serialized by a lock.
+class DownloadIndex:
+    def __init__(self, IndexPath: str = INDEX_FILE):
+        self.IndexPath = IndexPath
+        self.Lock = threading.Lock()
+
+        self.Connection = sqlite3.connect(IndexPath, check_same_thread=False)
+        # WAL mode keeps the database readable while a crawl is writing to it
+        self.Connection.execute("PRAGMA journal_mode=WAL")
+        # One row for each URL
+        self.Connection.execute(
+            "CREATE TABLE IF NOT EXISTS Downloads ("
+            "URL TEXT PRIMARY KEY, SavePath TEXT, ETag TEXT, LastModified TEXT, "
+            "Size INTEGER, Hash TEXT, UpdateTime REAL)"
+        )
+        # One row for each distinct content, pointing to the file that stores it
+        self.Connection.execute(
+            "CREATE TABLE IF NOT EXISTS Blobs (Hash TEXT PRIMARY KEY, SavePath TEXT, Size INTEGER)"
+        )
+        # The mtime of the saved file, added to the indexes created before it was recorded
+        for Table in ("Downloads", "Blobs"):
+            Columns = [Row[1] for Row in self.Connection.execute(f"PRAGMA table_info({Table})")]
+            if "MTime" not in Columns:
+                self.Connection.execute(f"ALTER TABLE {Table} ADD COLUMN MTime INTEGER")
+        self.Connection.commit()
+
+    # Get the record of a URL, or None if the URL has never been downloaded
+    def Lookup(self, URL: str) -> dict:
+        with self.Lock:
+            Row = self.Connection.execute(
+                "SELECT SavePath, ETag, LastModified, Size, Hash, MTime FROM Downloads WHERE URL = ?", (URL,)
+            ).fetchone()
+
+        if Row is None:
+            return None
+
+        return {"SavePath": Row[0], "ETag": Row[1], "LastModified": Row[2], "Size": Row[3], "Hash": Row[4], "MTime": Row[5]}
+
+    # Get the saved path of a URL if the file still holds the recorded content
+    # The file may have been overwritten by another download since, so the size and the mtime are checked,
+    # and the hash as well if the mtime has changed.
+    def KnownPath(self, URL: str) -> str:
+        Record = self.Lookup(URL)
+        if Record is None or not FileMatches(Record["SavePath"], Record["Size"], Record["Hash"], Record["MTime"]):
+            return None
+
+        return Record["SavePath"]
+
+    # Build the headers for a conditional request
+    # The headers are only useful when the previous download is still on disk,
+    # otherwise a 304 response would leave us without the image.
+    def ConditionalHeaders(self, URL: str) -> dict:
+        if self.KnownPath(URL) is None:
+            return {}
+
+        Record = self.Lookup(URL)
+        Headers = {}
+        if Record["ETag"]:
+            Headers["If-None-Match"] = Record["ETag"]
+        if Record["LastModified"]:
+            Headers["If-Modified-Since"] = Record["LastModified"]
+
+        return Headers
+
+    # Make the known content of a URL available at SavePath
+    # This is used when the server answers 304, or when a known URL is skipped.
+    def LinkKnown(self, URL: str, SavePath: str) -> bool:
+        KnownPath = self.KnownPath(URL)
+        if KnownPath is None:
+            return False
+
+        if os.path.abspath(KnownPath) != os.path.abspath(SavePath):
+            os.makedirs(os.path.dirname(SavePath), exist_ok=True)
+            LinkFile(KnownPath, SavePath)
+
+        return True
+
+    # Record a finished download whose content has been saved to SavePath
+    # If the same content has already been stored by another file, SavePath will be replaced by a hard link to it.
+    # Headers are the response headers, used to extract the validators for later conditional requests.
+    # Return the hash of the content.
+    def Record(self, URL: str, SavePath: str, Headers: dict = None) -> str:
+        Headers = Headers or {}
+        Hash = ComputeFileHash(SavePath)
+        Size = os.path.getsize(SavePath)
+
+        with self.Lock:
+            Row = self.Connection.execute("SELECT SavePath, Size, MTime FROM Blobs WHERE Hash = ?", (Hash,)).fetchone()
+        # Checking the file of the blob may read it through, so it is done without blocking the other workers
+        Reusable = (Row is not None and os.path.abspath(Row[0]) != os.path.abspath(SavePath)
+                    and FileMatches(Row[0], Row[1], Hash, Row[2]))
+
+        with self.Lock:
+            # SavePath no longer stores the content of its old blobs, which must not be linked to afterwards
+            self.Connection.execute("DELETE FROM Blobs WHERE SavePath = ? AND Hash != ?", (SavePath, Hash))
+
+            # Deduplicate the content if another file still stores it, otherwise SavePath becomes the file of the blob
+            # The blob checked above may have been replaced by another worker meanwhile, then it is not trusted.
+            Linked = Reusable and self.Connection.execute(
+                "SELECT SavePath, Size, MTime FROM Blobs WHERE Hash = ?", (Hash,)).fetchone() == Row
+            if Linked:
+                LinkFile(Row[0], SavePath)
+            # A hard link shares the mtime of the file it points to
+            MTime = os.stat(SavePath).st_mtime_ns
+            if not Linked:
+                self.Connection.execute(
+                    "INSERT OR REPLACE INTO Blobs (Hash, SavePath, Size, MTime) VALUES (?, ?, ?, ?)",
+                    (Hash, SavePath, Size, MTime)
+                )
+
+            self.Connection.execute(
+                "INSERT OR REPLACE INTO Downloads (URL, SavePath, ETag, LastModified, Size, Hash, MTime, UpdateTime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (URL, SavePath, Headers.get("ETag"), Headers.get("Last-Modified"), Size, Hash, MTime, time.time())
+            )
+            self.Connection.commit()
+
+        return Hash
+
+    # Close the database connection
+    def Close(self):
+        with self.Lock:
+            self.Connection.close()
+
+# Replace DestPath with a hard link to SourcePath
+# The link is created beside the destination first, so DestPath is always either the old file or the new link.
+# If the file system does not support hard links, DestPath will be a copy instead.
+def LinkFile(SourcePath: str, DestPath: str):
+    TempPath = DestPath + ".link"
+    try:
+        if os.path.exists(TempPath):
+            os.remove(TempPath)
+        os.link(SourcePath, TempPath)
+        os.replace(TempPath, DestPath)
+
+    except OSError as e:
+        LogMessage(f"Cannot hard link {SourcePath} to {DestPath}, keep a copy instead. Error: {str(e)}", Type="WARNING")
+        if not os.path.exists(DestPath):
+            shutil.copyfile(SourcePath, DestPath)
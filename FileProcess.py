@@ -12,14 +12,20 @@ LogMessage(Message, Type="INFO") -- Write LOGS to default log file
 GetFileNamesinDir(DirPath, SavePath=None) -> list -- Retrieve all file names in the file directory
 GetFileName(FilePath) -> str -- Return the content before the last point
 EncodeImageToBase64(ImagePath) -> str -- Encode the image to base64 string
+PrepareImagePayload(ImagePath, MaxSide=2048, Format="JPEG", Quality=85) -> str
+-- Downsize and re-encode the image into a base64 string for model requests, with an LRU cache
 '''
 
 import os
+import io
 import json
 import base64
 import logging
+import threading
 import mimetypes
 
+from collections import OrderedDict
+
 LOG_FILE = "Process.log"
 # Configure logging
 logging.basicConfig(
@@ -88,4 +94,88 @@ def EncodeImageToBase64(ImagePath: str) -> str:
         
     except Exception as e:
         LogMessage(f"Error reading image file: {ImagePath}. Error: {str(e)}", Type="ERROR")
-        return None
\ No newline at end of file
+        return None
+
+# The encoded payloads of PrepareImagePayload, keyed by path, modification time, size and settings
+# The least recently used payloads are dropped once the total length exceeds PAYLOAD_CACHE_BYTES.
+PAYLOAD_CACHE = OrderedDict()
+PAYLOAD_CACHE_BYTES = 256 * 1024 * 1024
+PAYLOAD_CACHE_LOCK = threading.Lock()
+PAYLOAD_CACHE_SIZE = 0
+
+# Downsize and re-encode the image into a base64 string for model requests
+# EncodeImageToBase64 sends the raw file, so a 12 MB PNG scan becomes a 16 MB request body.
+# Here the longer side is limited to MaxSide, and the image is re-encoded as Format ("JPEG" or "WEBP") with Quality.
+# The original bytes are kept if the image needs no resizing and is already in Format, or if re-encoding does not make it smaller.
+# The same image used by many prompts is only read and encoded once, thanks to the LRU cache.
+# PIL is imported here, so the other functions of this file keep depending on the standard library only.
+def PrepareImagePayload(ImagePath: str, MaxSide: int = 2048, Format: str = "JPEG", Quality: int = 85) -> str:
+    global PAYLOAD_CACHE_SIZE
+
+    try:
+        Stat = os.stat(ImagePath)
+        Key = (os.path.abspath(ImagePath), Stat.st_mtime_ns, Stat.st_size, MaxSide, Format.upper(), Quality)
+        with PAYLOAD_CACHE_LOCK:
+            if Key in PAYLOAD_CACHE:
+                PAYLOAD_CACHE.move_to_end(Key)
+                return PAYLOAD_CACHE[Key]
+
+        from PIL import Image
+        from PIL import ImageOps
+
+        with open(ImagePath, "rb") as ImageFile:
+            Original = ImageFile.read()
+
+        Img = Image.open(io.BytesIO(Original))
+        Format, OriginalFormat = Format.upper(), Img.format
+        NeedResize = MaxSide and max(Img.size) > MaxSide
+
+        if not NeedResize and OriginalFormat == Format:
+            Data = Original
+        else:
+            # Let the JPEG decoder scale down by itself, then resize precisely
+            if NeedResize:
+                Img.draft("RGB", (Img.width * MaxSide // max(Img.size), Img.height * MaxSide // max(Img.size)))
+            # Apply the EXIF orientation, since the EXIF data is not kept after re-encoding
+            Img = ImageOps.exif_transpose(Img)
+            if NeedResize:
+                Img.thumbnail((MaxSide, MaxSide), Image.Resampling.LANCZOS)
+
+            # JPEG keeps no transparency, so the transparent parts are filled with white
+            if Img.mode in ("RGBA", "LA", "P"):
+                Img = Img.convert("RGBA")
+                if Format == "JPEG":
+                    Background = Image.new("RGB", Img.size, "white")
+                    Background.paste(Img, mask=Img.getchannel("A"))
+                    Img = Background
+            elif Img.mode not in ("RGB", "L"):
+                Img = Img.convert("RGB")
+
+            Buffer = io.BytesIO()
+            Img.save(Buffer, format=Format, quality=Quality)
+            Data = Buffer.getvalue()
+
+            if not NeedResize and len(Data) >= len(Original):
+                Data, Format = Original, OriginalFormat
+
+        MimeType = Image.MIME.get(Format, "image/jpeg")
+        EncodedString = f"data:{MimeType};base64,{base64.b64encode(Data).decode('utf-8')}"
+        LogMessage(f"Prepared image payload: {ImagePath}, {Stat.st_size} -> {len(EncodedString)} bytes")
+
+        with PAYLOAD_CACHE_LOCK:
+            if Key not in PAYLOAD_CACHE:
+                PAYLOAD_CACHE[Key] = EncodedString
+                PAYLOAD_CACHE_SIZE += len(EncodedString)
+            while PAYLOAD_CACHE_SIZE > PAYLOAD_CACHE_BYTES and len(PAYLOAD_CACHE) > 1:
+                _, Dropped = PAYLOAD_CACHE.popitem(last=False)
+                PAYLOAD_CACHE_SIZE -= len(Dropped)
+
+        return EncodedString
+
+    except FileNotFoundError:
+        LogMessage(f"Image file not found: {ImagePath}", Type="ERROR")
+        return None
+
+    except Exception as e:
+        LogMessage(f"Error preparing image payload: {ImagePath}. Error: {str(e)}", Type="ERROR")
+        return None
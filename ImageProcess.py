@@ -8,14 +8,55 @@ So I gathered and encapsulated some common image processing functions here.
 Hope these functions can help you in your work and give you some inspiration.
 
 Function Table:
-LoadCLIPModel(ModelName: str = "ViT-B/32") -> (Model, Preprocess)
--- Load CLIP model for image embeddings
-Embeddings(ImagePaths: list, Model, Preprocess, BatchSize: int = 32) -> np.ndarray
--- Extract image embeddings using CLIP
-FoldersCompare(FolderA: str, FolderB: str, Threshold: float = 0.9, TopK: int = 5, SavePath: str = None) -> list
+LoadCLIPModel(ModelName: str = "ViT-B/32", Backend: str = "torch", OnnxPath: str = None, Threads: int = None) -> (Model, Preprocess)
+-- Load CLIP model for image embeddings with PyTorch, int8 quantized or ONNX Runtime backend, cached per process
+ClearModelCache()
+-- Release the CLIP models cached by LoadCLIPModel
+CheckBackendAccuracy(ImagePaths: list, ModelName: str = "ViT-B/32", Backend: str = "int8",
+                     OnnxPath: str = None, BatchSize: int = 32) -> dict
+-- Compare the embeddings of a backend with the fp32 embeddings
+EmbeddingCache(CacheDir: str, ModelName: str = "ViT-B/32")
+-- Initialize the on-disk store of image embeddings for one model
+Embeddings(ImagePaths: list, Model, Preprocess, BatchSize: int = 32, Cache: EmbeddingCache = None,
+           NumWorkers: int = 4, Prefetch: int = 2) -> np.ndarray
+-- Extract image embeddings using CLIP, decoding the next batches in background threads
+ShardedEmbeddings(ImagePaths: list, ModelName: str = "ViT-B/32", NumProcesses: int = None, ThreadsPerProcess: int = None,
+                  BatchSize: int = 32, NumWorkers: int = 1, OutputPath: str = None, Backend: str = "torch") -> np.ndarray
+-- Extract image embeddings by several CPU processes writing to one memory-mapped array
+FoldersCompare(FolderA: str, FolderB: str, Threshold: float = 0.9, TopK: int = 5, SavePath: str = None,
+               ModelName: str = "ViT-B/32", CacheDir: str = None,
+               IndexType: str = "Flat", IndexParams: dict = None, RecallSample: int = 0,
+               IndexPath: str = None, HashPrefilter: str = None, HashDistance: int = 4,
+               Columnar: bool = False) -> list | dict
 -- Compare the images in two folders and find out the similar ones
+FoldersCompareStream(FolderA: str, FolderB: str, SaveJsonlPath: str, Threshold: float = 0.9, TopK: int = 5,
+                     ChunkSize: int = 4096, ModelName: str = "ViT-B/32", CacheDir: str = None, IndexType: str = "Flat",
+                     IndexParams: dict = None, IndexPath: str = None, Resume: bool = True) -> int
+-- Compare the images in two folders chunk by chunk, appending the similar pairs to a JSONL file
+PerceptualHashes(ImagePaths: list, HashType: str = "phash", NumWorkers: int = 4) -> (np.ndarray, np.ndarray)
+-- Compute the 64-bit perceptual hashes of images in a vectorized pass
+HashMatches(HashesA: np.ndarray, HashesB: np.ndarray, MaxDistance: int = 4) -> (np.ndarray, np.ndarray, np.ndarray)
+-- Find all pairs of hashes within the Hamming distance by multi-index lookup
+BuildIndex(EmbeddingsA: np.ndarray, IndexType: str = "Flat", NList: int = None, M: int = 32,
+           NProbe: int = 16, EfSearch: int = 128, TrainSize: int = None, Ids: np.ndarray = None) -> faiss.Index
+-- Build an exact or approximate FAISS index over the embeddings
+IndexTypeOf(Index) -> str
+-- Get the type of an index built by BuildIndex
+EvaluateRecall(Index, EmbeddingsA: np.ndarray, EmbeddingsB: np.ndarray, TopK: int = 5, SampleSize: int = 1000) -> float
+-- Estimate the recall of an approximate index against the exact search
+ReferenceIndex(IndexPath: str, IndexType: str = "Flat", IndexParams: dict = None, ModelName: str = "ViT-B/32")
+-- Initialize the persisted, incrementally updatable index of a reference folder
+FolderDedup(Folder: str, Threshold: float = 0.9, TopK: int = None, SavePath: str = None,
+            ModelName: str = "ViT-B/32", CacheDir: str = None, IndexType: str = "Flat", IndexParams: dict = None) -> list
+-- Find the groups of similar images inside one folder
 AddWhiteBorder(ImagePath: str, BorderSize: int, SavePath: str = None) -> Image.Image
 -- Add white border around the image
+TransformImages(ImagePaths: list, SaveDir: str, Operations: list, NumProcesses: int = None,
+                Overwrite: bool = False, ChunkSize: int = 16) -> list
+-- Apply a chain of operations (border, resize, convert, recompress) to images in several processes
+TransformFolder(Folder: str, SaveDir: str, Operations: list, NumProcesses: int = None,
+                Overwrite: bool = False, ChunkSize: int = 16) -> list
+-- Apply a chain of operations to all images in a folder
 '''
 
 import os
@@ -26,14 +67,21 @@ import os
 # If you meet this problem as well, you can try to add the following line to avoid the error.
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
+import re
 import json
+import time
 import tqdm
+import inspect
+import hashlib
 
-import clip
-import torch
-import faiss
-# Determine whether to use GPU or CPU
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+import tempfile
+import importlib
+import threading
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -43,14 +91,183 @@ from PIL import ImageOps
 from FileProcess import LogMessage
 from FileProcess import GetFileNamesinDir
 
+# Module imported on its first attribute access
+# clip, torch and faiss take several seconds to import, which callers like AddWhiteBorder never need.
+class LazyModule:
+    def __init__(self, Name: str):
+        self.Name = Name
+        self.Module = None
+
+    def __getattr__(self, Attribute: str):
+        # Only called for the attributes not found on the proxy itself
+        if self.Module is None:
+            self.Module = importlib.import_module(self.Name)
+        return getattr(self.Module, Attribute)
+
+clip = LazyModule("clip")
+torch = LazyModule("torch")
+faiss = LazyModule("faiss")
+
+# The device to use, determined on first use so that importing this module does not import torch
+DEVICE = None
+
+# Determine whether to use GPU or CPU
+def GetDevice() -> str:
+    global DEVICE
+    if DEVICE is None:
+        DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    return DEVICE
+
+# Loaded CLIP models shared in this process, keyed by (ModelName, Device, Backend, OnnxPath, Threads)
+MODEL_CACHE = {}
+MODEL_CACHE_LOCK = threading.Lock()
+
 # Load CLIP model for image embeddings
-def LoadCLIPModel(ModelName: str = "ViT-B/32"):
-    Model, Preprocess = clip.load(ModelName, device=DEVICE)
-    # Set the model to evaluation mode
-    Model.eval()
+# The model is loaded once per process and returned from MODEL_CACHE afterwards,
+# so that only the first comparison pays for reading the weights.
+# Backend selects how the image encoder runs, all of them share the same Model / Preprocess interface:
+# "torch": The original PyTorch model on GetDevice().
+# "int8": The PyTorch model with dynamic int8 quantization of the linear layers, running on CPU.
+# "onnx": The image encoder exported to ONNX and run by ONNX Runtime on CPU.
+# "onnx-int8": The same as "onnx", with the weights quantized to int8.
+# The ONNX file is exported to OnnxPath the first time and reused afterwards.
+# Use CheckBackendAccuracy to see how far the embeddings of a backend are from the fp32 ones.
+# Threads: The number of CPU threads of the ONNX Runtime session, default to all cores.
+# The PyTorch backends share the threads of the process, which are set by torch.set_num_threads instead.
+def LoadCLIPModel(ModelName: str = "ViT-B/32", Backend: str = "torch", OnnxPath: str = None, Threads: int = None):
+    # All backends other than "torch" run on CPU
+    Key = (ModelName, GetDevice() if Backend == "torch" else "cpu", Backend, OnnxPath, Threads)
+    # Hold the lock while loading, so that concurrent callers wait for one load instead of doing their own
+    with MODEL_CACHE_LOCK:
+        if Key not in MODEL_CACHE:
+            MODEL_CACHE[Key] = LoadCLIPModelUncached(ModelName, Backend, OnnxPath, Threads)
+        return MODEL_CACHE[Key]
+
+# Release the CLIP models cached by LoadCLIPModel
+def ClearModelCache():
+    with MODEL_CACHE_LOCK:
+        MODEL_CACHE.clear()
+
+# Load CLIP model without the cache, the variables are the same as LoadCLIPModel
+def LoadCLIPModelUncached(ModelName: str = "ViT-B/32", Backend: str = "torch", OnnxPath: str = None,
+                          Threads: int = None):
+    if Backend == "torch":
+        Model, Preprocess = clip.load(ModelName, device=GetDevice())
+        # Set the model to evaluation mode
+        Model.eval()
+
+    elif Backend == "int8":
+        # Quantized kernels only run on CPU
+        Model, Preprocess = clip.load(ModelName, device="cpu")
+        Model = QuantizedCLIPModel(Model.eval())
+
+    elif Backend in ("onnx", "onnx-int8"):
+        OnnxPath = OnnxPath or re.sub(r"[^A-Za-z0-9]+", "-", ModelName) + (".int8" if Backend == "onnx-int8" else "") + ".onnx"
+        Model, Preprocess = clip.load(ModelName, device="cpu")
+        if not os.path.exists(OnnxPath):
+            ExportCLIPToONNX(Model, OnnxPath, Quantize=(Backend == "onnx-int8"))
+        Model = ONNXCLIPModel(OnnxPath, Threads)
+
+    else:
+        raise ValueError(f"Unknown CLIP backend: {Backend}")
 
     return Model, Preprocess
 
+# CLIP image encoder with dynamic int8 quantization
+# The weights of linear layers are stored in int8 and the activations are quantized on the fly,
+# which speeds up the transformer blocks on CPU with a small change of the embeddings.
+class QuantizedCLIPModel:
+    def __init__(self, Model):
+        self.Model = torch.ao.quantization.quantize_dynamic(Model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+        self.visual = self.Model.visual
+
+    def encode_image(self, ImageTensor):
+        return self.Model.encode_image(ImageTensor.cpu())
+
+    def eval(self):
+        return self
+
+# CLIP image encoder running in ONNX Runtime
+# ONNX Runtime is an optional dependency, which is only imported when this backend is used.
+class ONNXCLIPModel:
+    def __init__(self, OnnxPath: str, Threads: int = None):
+        import onnxruntime
+
+        Options = onnxruntime.SessionOptions()
+        if Threads:
+            Options.intra_op_num_threads = Threads
+        self.Session = onnxruntime.InferenceSession(OnnxPath, Options, providers=["CPUExecutionProvider"])
+        self.InputName = self.Session.get_inputs()[0].name
+
+    def encode_image(self, ImageTensor):
+        Feats = self.Session.run(None, {self.InputName: ImageTensor.cpu().numpy().astype("float32")})[0]
+        return torch.from_numpy(Feats)
+
+    def eval(self):
+        return self
+
+# Export the image encoder of a CLIP model to ONNX, with a dynamic batch dimension
+# If Quantize is True, the weights in the exported file are quantized to int8 by ONNX Runtime.
+def ExportCLIPToONNX(Model, OnnxPath: str, Quantize: bool = False):
+    # Wrap the encoder, so that the exported graph only contains the image branch
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self, Model):
+            super().__init__()
+            self.Model = Model
+
+        def forward(self, ImageTensor):
+            return self.Model.encode_image(ImageTensor)
+
+    Encoder = ImageEncoder(Model.float().cpu().eval())
+    Resolution = Model.visual.input_resolution
+    ExportPath = OnnxPath + ".fp32" if Quantize else OnnxPath
+
+    Options = {}
+    # Newer versions of PyTorch export with dynamo by default, which we do not need here
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        Options["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(Encoder, torch.randn(1, 3, Resolution, Resolution), ExportPath,
+                          input_names=["image"], output_names=["embedding"],
+                          dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
+                          opset_version=17, **Options)
+
+    if Quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(ExportPath, OnnxPath, weight_type=QuantType.QInt8)
+        os.remove(ExportPath)
+
+    LogMessage(f"CLIP image encoder exported to: {OnnxPath}", Type="INFO")
+
+# Compare the embeddings of a backend with the fp32 PyTorch embeddings on some sample images
+# Return the cosine similarity between the two embeddings of each image (mean and min),
+# the largest change of the similarity score between any two images, and the throughput of both backends.
+def CheckBackendAccuracy(ImagePaths: list, ModelName: str = "ViT-B/32", Backend: str = "int8",
+                         OnnxPath: str = None, BatchSize: int = 32) -> dict:
+    Timing = {}
+    Results = {}
+    for Name in ("torch", Backend):
+        Model, Preprocess = LoadCLIPModel(ModelName, Name, OnnxPath)
+        StartTime = time.time()
+        Results[Name] = Embeddings(ImagePaths, Model, Preprocess, BatchSize)
+        Timing[Name] = len(ImagePaths) / max(time.time() - StartTime, 1e-6)
+
+    Reference, Candidate = Results["torch"], Results[Backend]
+    Cosine = np.sum(Reference * Candidate, axis=1)
+    ScoreDiff = np.abs(Reference @ Reference.T - Candidate @ Candidate.T)
+
+    Report = {
+        "MeanCosine": float(Cosine.mean()),
+        "MinCosine": float(Cosine.min()),
+        "MaxScoreDiff": float(ScoreDiff.max()),
+        "ReferenceImagesPerSecond": Timing["torch"],
+        "BackendImagesPerSecond": Timing[Backend]
+    }
+    LogMessage(f"Accuracy of {Backend} backend against fp32 on {len(ImagePaths)} images: {Report}", Type="INFO")
+
+    return Report
+
 # Add white border around the image
 def AddWhiteBorder(ImagePath: str, BorderSize: int, SavePath: str = None) -> Image.Image:
     try:
@@ -69,31 +286,723 @@ def AddWhiteBorder(ImagePath: str, BorderSize: int, SavePath: str = None) -> Ima
         LogMessage(f"Error adding white border to image: {ImagePath}. Error: {str(e)}", Type="ERROR")
         return None
 
+# The file extension of each output format of "Recompress"
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "TIFF": ".tiff", "BMP": ".bmp"}
+
+# Decide the output path of an image in SaveDir
+# The name is kept, and the extension follows the format of the last "Recompress" operation if there is one.
+def TransformSavePath(ImagePath: str, SaveDir: str, Operations: list) -> str:
+    Name, Extension = os.path.splitext(os.path.basename(ImagePath))
+    for Operation, Params in Operations:
+        if Operation == "Recompress":
+            Extension = FORMAT_EXTENSIONS.get(Params.get("Format", "JPEG").upper(), Extension)
+    return os.path.join(SaveDir, Name + Extension)
+
+# Apply the operations to one image and save the result
+# This function must stay at the module level, so that it can be sent to the worker processes.
+# Return {"ImagePath": str, "SavePath": str, "Success": bool, "Skipped": bool}
+def TransformImageWorker(ImagePath: str, SavePath: str, Operations: list, Overwrite: bool = False) -> dict:
+    Result = {"ImagePath": ImagePath, "SavePath": SavePath, "Success": False, "Skipped": False}
+
+    # The output is up to date if it is not older than the source image
+    if not Overwrite and os.path.exists(SavePath) and os.path.getmtime(SavePath) >= os.path.getmtime(ImagePath):
+        Result["Success"] = Result["Skipped"] = True
+        return Result
+
+    try:
+        Img = Image.open(ImagePath)
+        SaveOptions = {"format": Img.format}
+        if "dpi" in Img.info:
+            # Keep the resolution of scans, which OCR engines rely on
+            SaveOptions["dpi"] = Img.info["dpi"]
+
+        # If the first operation changing the size is "Resize", let the JPEG decoder scale down by itself,
+        # which skips most of the decoding work of large photos and scans
+        for Operation, Params in Operations:
+            if Operation == "Resize":
+                Img.draft(Img.mode, ResizeTarget(Img.size, Params))
+            if Operation != "Convert":
+                break
+
+        for Operation, Params in Operations:
+            if Operation == "Border":
+                Img = ImageOps.expand(Img, border=Params["Size"], fill=Params.get("Fill", "white"))
+            elif Operation == "Resize":
+                Target = ResizeTarget(Img.size, Params)
+                if Target != Img.size:
+                    Img = Img.resize(Target, Image.Resampling.LANCZOS)
+            elif Operation == "Convert":
+                Img = Img.convert(Params["Mode"])
+            elif Operation == "Recompress":
+                SaveOptions["format"] = Params.get("Format", "JPEG").upper()
+                SaveOptions["quality"] = Params.get("Quality", 90)
+                SaveOptions["optimize"] = Params.get("Optimize", False)
+            else:
+                raise ValueError(f"Unknown operation: {Operation}")
+
+        # JPEG keeps neither transparency nor palette
+        if SaveOptions["format"] == "JPEG" and Img.mode not in ("RGB", "L", "CMYK"):
+            Img = Img.convert("RGB")
+
+        # Write to a temporary file first, so that an interrupted run never leaves a broken output
+        TempPath = SavePath + ".part"
+        Img.save(TempPath, **SaveOptions)
+        os.replace(TempPath, SavePath)
+        Result["Success"] = True
+
+    except Exception as e:
+        LogMessage(f"Error transforming image: {ImagePath}. Error: {str(e)}", Type="ERROR")
+
+    return Result
+
+# Compute the size after "Resize"
+# Params: {"Size": (Width, Height)} for an exact size, or {"MaxSide": int} to fit the longer side without enlarging.
+def ResizeTarget(Size: tuple, Params: dict) -> tuple:
+    if "Size" in Params:
+        return tuple(Params["Size"])
+    Scale = min(1.0, Params["MaxSide"] / max(Size))
+    return (max(1, round(Size[0] * Scale)), max(1, round(Size[1] * Scale)))
+
+# Apply a chain of operations to images in several processes
+# It generalizes AddWhiteBorder from one image per call to a batch, for example padding scans for OCR.
+# Operations: A list of (Name, Params) applied in order, the supported ones are:
+# ("Border", {"Size": int, "Fill": "white"}): Add a border around the image.
+# ("Resize", {"MaxSide": int} or {"Size": (Width, Height)}): Scale the image, JPEG images are scaled in the decoder by Image.draft.
+# ("Convert", {"Mode": str}): Convert the image mode, e.g. "L" for grayscale.
+# ("Recompress", {"Format": "JPEG", "Quality": 90, "Optimize": False}): Save in another format or quality.
+# The results are saved in SaveDir with the same names. Outputs not older than their source images are skipped
+# unless Overwrite is True. Note that changing Operations does not make the outputs outdated, use Overwrite then.
+# NumProcesses: The number of worker processes, default to the number of CPU cores.
+# ChunkSize: The number of images sent to a worker at once.
+# Return [{"ImagePath": str, "SavePath": str, "Success": bool, "Skipped": bool}] in the order of ImagePaths.
+def TransformImages(ImagePaths: list, SaveDir: str, Operations: list, NumProcesses: int = None,
+                    Overwrite: bool = False, ChunkSize: int = 16) -> list:
+    os.makedirs(SaveDir, exist_ok=True)
+    Operations = [(Operation, dict(Params or {})) for Operation, Params in Operations]
+    SavePaths = [TransformSavePath(ImagePath, SaveDir, Operations) for ImagePath in ImagePaths]
+    NumProcesses = max(1, min(NumProcesses or os.cpu_count() or 1, len(ImagePaths) or 1))
+
+    StartTime = time.time()
+    # Spawn fresh interpreters, since the caller may have torch threads running
+    Context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=NumProcesses, mp_context=Context) as Executor:
+        Results = list(tqdm.tqdm(Executor.map(TransformImageWorker, ImagePaths, SavePaths,
+                                              [Operations] * len(ImagePaths), [Overwrite] * len(ImagePaths),
+                                              chunksize=max(1, ChunkSize)),
+                                 total=len(ImagePaths), desc="Transform images"))
+
+    Elapsed = max(time.time() - StartTime, 1e-6)
+    Processed = sum(Result["Success"] and not Result["Skipped"] for Result in Results)
+    Skipped = sum(Result["Skipped"] for Result in Results)
+    LogMessage(f"Transformed {Processed}/{len(ImagePaths)} images ({Skipped} up to date) in {Elapsed:.2f}s "
+               f"({Processed / Elapsed:.2f} images/s)", Type="INFO")
+
+    return Results
+
+# Apply a chain of operations to all images in a folder
+# The variables are the same as TransformImages.
+def TransformFolder(Folder: str, SaveDir: str, Operations: list, NumProcesses: int = None,
+                    Overwrite: bool = False, ChunkSize: int = 16) -> list:
+    if not os.path.exists(Folder):
+        LogMessage(f"Folder does not exist: {Folder}", Type="ERROR")
+        return []
+
+    return TransformImages(GetImagePaths(Folder), SaveDir, Operations, NumProcesses, Overwrite, ChunkSize)
+
+# Compute the SHA-256 hash of an image file
+def ImageHash(ImagePath: str) -> str:
+    Hasher = hashlib.sha256()
+    with open(ImagePath, "rb") as f:
+        for Chunk in iter(lambda: f.read(1048576), b""):
+            Hasher.update(Chunk)
+
+    return Hasher.hexdigest()
+
+# On-disk store of image embeddings for one model
+# The embeddings are appended to a raw float32 file, which is memory-mapped when reading,
+# and a sidecar JSON index maps each image path to its size, mtime, content hash and row in the file.
+# The new entries are appended to a JSONL journal next to the index, like the rows of the data file,
+# so adding a chunk costs as much as the chunk itself. Save folds the journal into the index, which is done
+# when the store is opened and at the end of a run.
+# All entries are kept in memory, about a few hundred bytes per image, which bounds the size of the archive
+# one process can cache.
+# An image is considered unchanged if its size and mtime are the same as recorded.
+# Otherwise its content hash is computed, so that a touched or renamed image still reuses its embedding.
+# The store lives in a subfolder of CacheDir named after the model, since different models give different embeddings.
+class EmbeddingCache:
+    def __init__(self, CacheDir: str, ModelName: str = "ViT-B/32"):
+        self.ModelName = ModelName
+        self.CacheDir = os.path.join(CacheDir, re.sub(r"[^A-Za-z0-9]+", "-", ModelName))
+        self.DataPath = os.path.join(self.CacheDir, "Embeddings.f32")
+        self.IndexPath = os.path.join(self.CacheDir, "Index.json")
+        self.JournalPath = os.path.join(self.CacheDir, "Index.jsonl")
+        os.makedirs(self.CacheDir, exist_ok=True)
+
+        self.Dim = None
+        self.Count = 0
+        # {ImagePath: {"Size": int, "MTime": int, "Hash": str, "Row": int}}
+        self.Entries = {}
+        if os.path.exists(self.IndexPath):
+            with open(self.IndexPath, "r", encoding="utf-8") as f:
+                Index = json.load(f)
+            if Index.get("ModelName") == ModelName:
+                self.Dim = Index["Dim"]
+                self.Count = Index["Count"]
+                self.Entries = Index["Entries"]
+            else:
+                LogMessage(f"Embedding cache {self.CacheDir} belongs to another model, it will be rebuilt.", Type="WARNING")
+        # The entries changed since the index was last saved and not written to the journal yet
+        self.Dirty = {}
+        if self.ReadJournal():
+            self.Save()
+
+        # Find the row of each content hash
+        self.HashToRow = {Entry["Hash"]: Entry["Row"] for Entry in self.Entries.values()}
+        # The hashes computed during lookup, which will be reused when adding the embeddings
+        self.PendingHashes = {}
+        self.Data = None
+
+    # Apply the entries in the journal left by the last run to the index, return whether there were any
+    # A broken last line left by a crash is ignored, the rows it refers to will be cut off from the data file.
+    def ReadJournal(self) -> bool:
+        if not os.path.exists(self.JournalPath):
+            return False
+
+        with open(self.JournalPath, "r", encoding="utf-8") as f:
+            for Line in f:
+                try:
+                    Entry = json.loads(Line)
+                except json.JSONDecodeError:
+                    continue
+
+                if "ModelName" in Entry:
+                    # The header written when the journal was started
+                    if Entry["ModelName"] != self.ModelName:
+                        LogMessage(f"Embedding journal {self.JournalPath} belongs to another model, it is ignored.", Type="WARNING")
+                        return True
+                    self.Dim = self.Dim or Entry["Dim"]
+                else:
+                    Key = Entry.pop("Path")
+                    self.Entries[Key] = Entry
+                    self.Count = max(self.Count, Entry["Row"] + 1)
+
+        return True
+
+    # Append the changed entries to the journal
+    def Flush(self):
+        if not self.Dirty:
+            return
+
+        with open(self.JournalPath, "a", encoding="utf-8") as f:
+            if f.tell() == 0:
+                f.write(json.dumps({"ModelName": self.ModelName, "Dim": self.Dim}) + "\n")
+            f.writelines(json.dumps({"Path": Key, **Entry}, ensure_ascii=False) + "\n" for Key, Entry in self.Dirty.items())
+        self.Dirty = {}
+
+    # Memory-map the embeddings that have been written
+    def OpenData(self):
+        if self.Data is None and self.Count:
+            self.Data = np.memmap(self.DataPath, dtype="float32", mode="r", shape=(self.Count, self.Dim))
+
+        return self.Data
+
+    # Find the rows of the images in the store, None for the new or changed images
+    def Lookup(self, ImagePaths: list) -> list:
+        Rows = []
+        for ImagePath in ImagePaths:
+            Key = os.path.abspath(ImagePath)
+            Stat = os.stat(ImagePath)
+            Entry = self.Entries.get(Key)
+
+            if Entry and Entry["Size"] == Stat.st_size and Entry["MTime"] == Stat.st_mtime_ns:
+                Rows.append(Entry["Row"])
+                continue
+
+            # The size or mtime has changed, or the path is new, so we check the content instead
+            Hash = ImageHash(ImagePath)
+            if Hash in self.HashToRow:
+                self.Entries[Key] = self.Dirty[Key] = {"Size": Stat.st_size, "MTime": Stat.st_mtime_ns, "Hash": Hash,
+                                                       "Row": self.HashToRow[Hash]}
+                Rows.append(self.HashToRow[Hash])
+            else:
+                self.PendingHashes[Key] = Hash
+                Rows.append(None)
+
+        return Rows
+
+    # Read the embeddings of the given rows
+    def Get(self, Rows: list) -> np.ndarray:
+        return np.asarray(self.OpenData()[Rows], dtype="float32")
+
+    # Append the embeddings of new images to the store, and return their rows
+    def Add(self, ImagePaths: list, NewEmbeddings: np.ndarray) -> list:
+        NewEmbeddings = np.ascontiguousarray(NewEmbeddings, dtype="float32")
+        if self.Dim is None:
+            self.Dim = NewEmbeddings.shape[1]
+
+        # The data file may have rows beyond the index if the last run crashed, so we cut them off first
+        with open(self.DataPath, "ab") as f:
+            f.truncate(self.Count * self.Dim * 4)
+            f.write(NewEmbeddings.tobytes())
+
+        Rows = []
+        for Offset, ImagePath in enumerate(ImagePaths):
+            Key = os.path.abspath(ImagePath)
+            Stat = os.stat(ImagePath)
+            Hash = self.PendingHashes.pop(Key, None) or ImageHash(ImagePath)
+            Row = self.Count + Offset
+
+            self.Entries[Key] = self.Dirty[Key] = {"Size": Stat.st_size, "MTime": Stat.st_mtime_ns, "Hash": Hash, "Row": Row}
+            self.HashToRow[Hash] = Row
+            Rows.append(Row)
+
+        self.Count += len(ImagePaths)
+        self.Data = None
+        self.Flush()
+
+        return Rows
+
+    # Write the whole index atomically and start a new journal, so a crash never leaves a broken index behind
+    def Save(self):
+        TempPath = self.IndexPath + ".tmp"
+        with open(TempPath, "w", encoding="utf-8") as f:
+            json.dump({"ModelName": self.ModelName, "Dim": self.Dim, "Count": self.Count, "Entries": self.Entries},
+                      f, ensure_ascii=False)
+        os.replace(TempPath, self.IndexPath)
+        self.Dirty = {}
+        if os.path.exists(self.JournalPath):
+            os.remove(self.JournalPath)
+
+# Decode and preprocess one image
+# Return None if the image cannot be read, so that one corrupt file does not kill the whole run.
+def LoadImageTensor(ImagePath: str, Preprocess):
+    try:
+        Img = Image.open(ImagePath).convert("RGB")
+        return Preprocess(Img)
+
+    except Exception as e:
+        LogMessage(f"Skip unreadable image: {ImagePath}. Error: {str(e)}", Type="WARNING")
+        return None
+
+# Decode the batches of images in background threads
+# While the model is encoding one batch, the following Prefetch batches are being decoded by NumWorkers threads.
+# PIL and torchvision release the GIL during most of the decoding and resizing work, so threads are enough here.
+# If NumWorkers is 0, the images will be decoded on the calling thread.
+# Yield the indices of each batch and the list of preprocessed tensors (None for unreadable images).
+def PrefetchBatches(ImagePaths: list, Preprocess, BatchSize: int = 32, NumWorkers: int = 4, Prefetch: int = 2):
+    Batches = [range(i, min(i + BatchSize, len(ImagePaths))) for i in range(0, len(ImagePaths), BatchSize)]
+
+    if NumWorkers <= 0:
+        for Batch in Batches:
+            yield Batch, [LoadImageTensor(ImagePaths[i], Preprocess) for i in Batch]
+        return
+
+    with ThreadPoolExecutor(max_workers=NumWorkers) as Executor:
+        Pending = deque()
+        for Batch in Batches:
+            Pending.append((Batch, [Executor.submit(LoadImageTensor, ImagePaths[i], Preprocess) for i in Batch]))
+            # Keep Prefetch batches in flight behind the one handed to the model
+            if len(Pending) > Prefetch:
+                Ready, Futures = Pending.popleft()
+                yield Ready, [Future.result() for Future in Futures]
+
+        while Pending:
+            Ready, Futures = Pending.popleft()
+            yield Ready, [Future.result() for Future in Futures]
+
 # Extract image embeddings using CLIP
-@torch.no_grad()
-def Embeddings(ImagePaths: list, Model, Preprocess, BatchSize: int = 32):
-    EmbeddingsList = []
+# If a cache is provided, only the new or changed images will go through the model,
+# and their embeddings will be added to the cache.
+# NumWorkers and Prefetch control the background decoding, see PrefetchBatches.
+# The returned rows keep the order of ImagePaths. Unreadable images get zero rows, which never pass any threshold.
+def Embeddings(ImagePaths: list, Model, Preprocess, BatchSize: int = 32, Cache: EmbeddingCache = None,
+               NumWorkers: int = 4, Prefetch: int = 2):
+    # No gradients are needed for inference, torch is only imported when this function is called
+    with torch.no_grad():
+        return EmbeddingsNoGrad(ImagePaths, Model, Preprocess, BatchSize, Cache, NumWorkers, Prefetch)
+
+# The body of Embeddings, running under torch.no_grad
+def EmbeddingsNoGrad(ImagePaths: list, Model, Preprocess, BatchSize: int = 32, Cache: EmbeddingCache = None,
+                     NumWorkers: int = 4, Prefetch: int = 2):
+    if Cache is not None:
+        Rows = Cache.Lookup(ImagePaths)
+        Missing = [i for i, Row in enumerate(Rows) if Row is None]
+        LogMessage(f"Embeddings of {len(ImagePaths) - len(Missing)}/{len(ImagePaths)} images loaded from cache", Type="INFO")
+
+        if Missing:
+            NewEmbeddings = Embeddings([ImagePaths[i] for i in Missing], Model, Preprocess, BatchSize,
+                                       NumWorkers=NumWorkers, Prefetch=Prefetch)
+            # Unreadable images are not cached, so they will be tried again next time
+            Readable = [k for k in range(len(Missing)) if NewEmbeddings[k].any()]
+            if Readable:
+                NewRows = Cache.Add([ImagePaths[Missing[k]] for k in Readable], NewEmbeddings[Readable])
+                for k, Row in zip(Readable, NewRows):
+                    Rows[Missing[k]] = Row
+        # Save the entries updated by the content hash
+        Cache.Flush()
 
-    for i in tqdm.tqdm(range(0, len(ImagePaths), BatchSize), desc="Extract embeddings"):
-        Batch = ImagePaths[i:i + BatchSize]
+        Known = [i for i, Row in enumerate(Rows) if Row is not None]
+        Output = np.zeros((len(ImagePaths), Cache.Dim or 0), dtype="float32")
+        if Known:
+            Output[Known] = Cache.Get([Rows[i] for i in Known])
 
-        Images = []
-        for Pic in Batch:
-            # Preprocess each image
-            Img = Image.open(Pic).convert("RGB")
-            # Append the preprocessed image to the list
-            Images.append(Preprocess(Img))
+        return Output
+
+    # The output array will be allocated once the embedding dimension is known
+    Output = None
+
+    for Batch, Images in tqdm.tqdm(PrefetchBatches(ImagePaths, Preprocess, BatchSize, NumWorkers, Prefetch),
+                                   total=(len(ImagePaths) + BatchSize - 1) // BatchSize, desc="Extract embeddings"):
+        # Drop the unreadable images in this batch
+        Valid = [i for i, Img in zip(Batch, Images) if Img is not None]
+        if not Valid:
+            continue
 
         # Stack images into a batch tensor
-        ImageTensor = torch.stack(Images).to(DEVICE)
+        ImageTensor = torch.stack([Img for Img in Images if Img is not None]).to(GetDevice())
         # Get the image embeddings from the model
         Feats = Model.encode_image(ImageTensor)
         # Normalize the embeddings
         Feats = Feats / Feats.norm(dim=1,keepdim=True)
-        # Append the embeddings to the list
-        EmbeddingsList.append(Feats.cpu().numpy())
-    
-    return np.vstack(EmbeddingsList).astype("float32")
+        Feats = Feats.cpu().numpy().astype("float32")
+
+        # Write the embeddings to their rows
+        if Output is None:
+            Output = np.zeros((len(ImagePaths), Feats.shape[1]), dtype="float32")
+        Output[Valid] = Feats
+
+    if Output is None:
+        LogMessage("No readable image to extract embeddings.", Type="WARNING")
+        return np.zeros((len(ImagePaths), 0), dtype="float32")
+
+    return Output
+
+# Obtain all image paths in a folder, sorted by names so that the order is stable between runs
+def GetImagePaths(Folder: str) -> list:
+    ImageNames = GetFileNamesinDir(Folder)
+    ImageNames = [name for name in ImageNames
+                  if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'))]
+
+    return [os.path.join(Folder, Name) for Name in sorted(ImageNames)]
+
+# Build a FAISS index over the normalized embeddings, so that inner product means cosine similarity
+# The exact "Flat" index costs O(|A|) for each query, which does not scale to millions of images.
+# The approximate indexes trade a little recall for much faster search:
+# "IVFFlat": Inverted file with NList clusters, only NProbe clusters are scanned for each query.
+# "IVFPQ": Inverted file with product quantization into M bytes per vector, which also shrinks the memory footprint.
+# "HNSW": Hierarchical navigable small world graph with M links per node, EfSearch controls the search depth.
+# The IVF indexes need training, which uses at most TrainSize randomly sampled embeddings.
+# If Ids are given, the index will be wrapped by an id map, and searching returns these ids instead of the positions.
+def BuildIndex(EmbeddingsA: np.ndarray, IndexType: str = "Flat", NList: int = None, M: int = 32,
+               NProbe: int = 16, EfSearch: int = 128, TrainSize: int = None, Ids: np.ndarray = None):
+    Count, Dim = EmbeddingsA.shape
+    # The rule of thumb for the number of clusters
+    NList = NList or max(1, int(4 * np.sqrt(Count)))
+
+    if IndexType == "Flat":
+        Description = "Flat"
+    elif IndexType == "IVFFlat":
+        Description = f"IVF{NList},Flat"
+    elif IndexType == "IVFPQ":
+        Description = f"IVF{NList},PQ{M}"
+    elif IndexType == "HNSW":
+        Description = f"HNSW{M}"
+    else:
+        raise ValueError(f"Unknown index type: {IndexType}")
+
+    # Too few images to train the clusters, the exact index is cheap enough anyway
+    # Each PQ sub-quantizer has 256 centroids, so it needs at least 256 training vectors
+    MinTrainSize = max(NList, 256) if IndexType == "IVFPQ" else NList
+    if IndexType.startswith("IVF") and Count < MinTrainSize:
+        LogMessage(f"Only {Count} images for {Description} index, fall back to Flat index.", Type="WARNING")
+        Description = "Flat"
+
+    Index = faiss.index_factory(Dim, ("IDMap2," if Ids is not None else "") + Description, faiss.METRIC_INNER_PRODUCT)
+
+    if not Index.is_trained:
+        TrainSize = min(Count, TrainSize or max(MinTrainSize, 64 * NList))
+        Sample = np.random.default_rng(0).choice(Count, TrainSize, replace=False)
+        Index.train(EmbeddingsA[np.sort(Sample)])
+        LogMessage(f"{Description} index trained with {TrainSize} embeddings.", Type="INFO")
+
+    if Ids is not None:
+        Index.add_with_ids(EmbeddingsA, np.asarray(Ids, dtype="int64"))
+    else:
+        Index.add(EmbeddingsA)
+
+    SetSearchParams(Index, NProbe, EfSearch)
+
+    return Index
+
+# Set the search parameters of an approximate index, which are ignored by the exact index
+def SetSearchParams(Index, NProbe: int = 16, EfSearch: int = 128):
+    # Look through the id map for the real index type
+    BaseIndex = faiss.downcast_index(Index.index) if isinstance(Index, faiss.IndexIDMap) else Index
+
+    if isinstance(BaseIndex, faiss.IndexIVF):
+        faiss.ParameterSpace().set_index_parameter(Index, "nprobe", NProbe)
+    elif isinstance(BaseIndex, faiss.IndexHNSW):
+        faiss.ParameterSpace().set_index_parameter(Index, "efSearch", EfSearch)
+
+# Get the type of an index built by BuildIndex, which may be "Flat" when an IVF index fell back for too few images
+def IndexTypeOf(Index) -> str:
+    BaseIndex = faiss.downcast_index(Index.index) if isinstance(Index, faiss.IndexIDMap) else Index
+
+    if isinstance(BaseIndex, faiss.IndexIVFPQ):
+        return "IVFPQ"
+    if isinstance(BaseIndex, faiss.IndexIVF):
+        return "IVFFlat"
+    if isinstance(BaseIndex, faiss.IndexHNSW):
+        return "HNSW"
+    return "Flat"
+
+# Estimate the recall of an approximate index against the exact search on a sample of queries
+# The recall is the fraction of the exact TopK neighbors that are also found by the index.
+def EvaluateRecall(Index, EmbeddingsA: np.ndarray, EmbeddingsB: np.ndarray, TopK: int = 5, SampleSize: int = 1000) -> float:
+    Sample = np.random.default_rng(0).choice(len(EmbeddingsB), min(SampleSize, len(EmbeddingsB)), replace=False)
+    Queries = EmbeddingsB[np.sort(Sample)]
+
+    Exact = faiss.IndexFlatIP(EmbeddingsA.shape[1])
+    Exact.add(EmbeddingsA)
+    _, ExactIndices = Exact.search(Queries, TopK)
+    _, ApproxIndices = Index.search(Queries, TopK)
+
+    Found = sum(len(set(E) & set(A)) for E, A in zip(ExactIndices.tolist(), ApproxIndices.tolist()))
+    Recall = Found / ExactIndices.size
+    LogMessage(f"Recall@{TopK} of the index on {len(Queries)} queries: {Recall:.4f}", Type="INFO")
+
+    return Recall
+
+# FAISS index of a reference folder persisted on disk
+# Instead of rebuilding the index of a fixed archive for every comparison,
+# we build it once, save it by faiss.write_index, and keep a sidecar JSON file beside it:
+# {"ModelName": str, "IndexType": str, "BuiltType": str, "NextId": int,
+#  "Entries": {ImagePath: {"Id": int, "Size": int, "MTime": int}}}
+# Each image has a stable id, so new images can be added and deleted ones removed by id without a full rebuild.
+# BuiltType is the type actually built, which is "Flat" if the folder was too small for the requested IVF index.
+# Such an index is rebuilt as the requested type once new images are added.
+# When all images are removed, the index and the sidecar are deleted.
+# When nothing has changed, the index is memory-mapped instead of being read into memory.
+class ReferenceIndex:
+    def __init__(self, IndexPath: str, IndexType: str = "Flat", IndexParams: dict = None, ModelName: str = "ViT-B/32"):
+        self.IndexPath = IndexPath
+        self.MapPath = IndexPath + ".json"
+        self.IndexType = IndexType
+        self.IndexParams = IndexParams or {}
+        self.ModelName = ModelName
+
+        self.Index = None
+        self.BuiltType = IndexType
+        self.NextId = 0
+        self.Entries = {}
+        if os.path.exists(self.IndexPath) and os.path.exists(self.MapPath):
+            with open(self.MapPath, "r", encoding="utf-8") as f:
+                Map = json.load(f)
+            if Map.get("ModelName") == ModelName and Map.get("IndexType") == IndexType:
+                self.BuiltType = Map.get("BuiltType", IndexType)
+                self.NextId = Map["NextId"]
+                self.Entries = Map["Entries"]
+            else:
+                LogMessage(f"Reference index {IndexPath} was built with another model or index type, it will be rebuilt.", Type="WARNING")
+
+    # Read the index from disk
+    # A memory-mapped index is read-only, so it is only used when no update is needed.
+    def Load(self, MemoryMap: bool = False):
+        if MemoryMap:
+            try:
+                self.Index = faiss.read_index(self.IndexPath, faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                # Not every index type can be memory-mapped
+                self.Index = faiss.read_index(self.IndexPath)
+        else:
+            self.Index = faiss.read_index(self.IndexPath)
+
+        SetSearchParams(self.Index, self.IndexParams.get("NProbe", 16), self.IndexParams.get("EfSearch", 128))
+
+    # Write the index and the sidecar atomically
+    def Save(self):
+        faiss.write_index(self.Index, self.IndexPath + ".tmp")
+        os.replace(self.IndexPath + ".tmp", self.IndexPath)
+
+        with open(self.MapPath + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"ModelName": self.ModelName, "IndexType": self.IndexType, "BuiltType": self.BuiltType,
+                       "NextId": self.NextId, "Entries": self.Entries}, f, ensure_ascii=False)
+        os.replace(self.MapPath + ".tmp", self.MapPath)
+
+    # Delete the index and the sidecar when no image is left, so the removals are not repeated by the next run
+    def Delete(self):
+        for FilePath in (self.IndexPath, self.MapPath):
+            if os.path.exists(FilePath):
+                os.remove(FilePath)
+        self.NextId = 0
+
+    # Get the list of image paths indexed by their ids, None for the removed ids
+    def PathsById(self) -> list:
+        Paths = [None] * self.NextId
+        for ImagePath, Entry in self.Entries.items():
+            Paths[Entry["Id"]] = ImagePath
+
+        return Paths
+
+    # Add the images with their embeddings to the index
+    def Add(self, ImagePaths: list, NewEmbeddings: np.ndarray):
+        Ids = np.arange(self.NextId, self.NextId + len(ImagePaths), dtype="int64")
+
+        if self.Index is None:
+            # The first images decide the clusters of IVF indexes
+            self.Index = BuildIndex(NewEmbeddings, self.IndexType, Ids=Ids, **self.IndexParams)
+            self.BuiltType = IndexTypeOf(self.Index)
+        else:
+            self.Index.add_with_ids(NewEmbeddings, Ids)
+
+        for ImagePath, Id in zip(ImagePaths, Ids.tolist()):
+            Stat = os.stat(ImagePath)
+            self.Entries[ImagePath] = {"Id": Id, "Size": Stat.st_size, "MTime": Stat.st_mtime_ns}
+        self.NextId += len(ImagePaths)
+
+    # Remove the images from the index by their ids
+    def Remove(self, ImagePaths: list):
+        Ids = np.array([self.Entries.pop(ImagePath)["Id"] for ImagePath in ImagePaths], dtype="int64")
+        try:
+            self.Index.remove_ids(Ids)
+
+        except RuntimeError:
+            # HNSW graphs do not support removal, so we rebuild the index from the stored vectors of the rest
+            LogMessage(f"{self.IndexType} index does not support removal, rebuild it from the remaining vectors.", Type="WARNING")
+            self.Rebuild()
+
+    # Rebuild the index as the requested type from the stored vectors of the images in Entries
+    def Rebuild(self):
+        KeptIds = np.array([Entry["Id"] for Entry in self.Entries.values()], dtype="int64")
+        OldIndex, self.Index = self.Index, None
+        if len(KeptIds):
+            Vectors = np.vstack([OldIndex.reconstruct(int(Id)) for Id in KeptIds]).astype("float32")
+            self.Index = BuildIndex(Vectors, self.IndexType, Ids=KeptIds, **self.IndexParams)
+            self.BuiltType = IndexTypeOf(self.Index)
+
+    # Bring the index up to date with the given images
+    # The images that are new or modified (by size and mtime) will be embedded and added,
+    # and the images that no longer exist or have been modified will be removed.
+    def Sync(self, ImagePaths: list, Model, Preprocess, Cache: EmbeddingCache = None):
+        Current = {}
+        for ImagePath in ImagePaths:
+            Stat = os.stat(ImagePath)
+            Current[ImagePath] = (Stat.st_size, Stat.st_mtime_ns)
+
+        Removed = [ImagePath for ImagePath, Entry in self.Entries.items()
+                   if Current.get(ImagePath) != (Entry["Size"], Entry["MTime"])]
+        Added = [ImagePath for ImagePath in ImagePaths
+                 if ImagePath not in self.Entries or ImagePath in Removed]
+
+        if self.Entries:
+            self.Load(MemoryMap=not (Added or Removed))
+        if not (Added or Removed):
+            LogMessage(f"Reference index {self.IndexPath} is up to date with {len(self.Entries)} images.", Type="INFO")
+            return
+
+        if Removed:
+            self.Remove(Removed)
+
+        if Added:
+            NewEmbeddings = Embeddings(Added, Model, Preprocess, Cache=Cache)
+            # Unreadable images are left out, so they will be tried again next time
+            Readable = np.flatnonzero(np.linalg.norm(NewEmbeddings, axis=1) > 0)
+            if len(Readable):
+                # An index that fell back to Flat is built again as the requested type with the new images
+                Upgrade = self.Index is not None and self.BuiltType != self.IndexType
+                self.Add([Added[i] for i in Readable], NewEmbeddings[Readable])
+                if Upgrade:
+                    self.Rebuild()
+
+        if self.Entries:
+            self.Save()
+        else:
+            self.Delete()
+        LogMessage(f"Reference index {self.IndexPath} updated: {len(Added)} added, {len(Removed)} removed.", Type="INFO")
+
+# The embedding dimensions of the CLIP models, so that the output array can be allocated before loading any model
+EMBEDDING_DIMS = {
+    "RN50": 1024, "RN101": 512, "RN50x4": 640, "RN50x16": 768, "RN50x64": 1024,
+    "ViT-B/32": 512, "ViT-B/16": 512, "ViT-L/14": 768, "ViT-L/14@336px": 768
+}
+
+# Embed one shard of images in a worker process and write the embeddings to the shared output file
+# This function must stay at the module level, so that it can be sent to the worker processes.
+def EmbeddingsShardWorker(ImagePaths: list, Start: int, OutputPath: str, Shape: tuple, ModelName: str,
+                          Threads: int, BatchSize: int, NumWorkers: int, Backend: str = "torch") -> int:
+    # Each worker owns its threads, instead of all workers fighting for every core
+    global DEVICE
+    DEVICE = "cpu"
+    torch.set_num_threads(Threads)
+
+    # ONNX Runtime has its own thread pool, which would use every core if not limited as well
+    Model, Preprocess = LoadCLIPModel(ModelName, Backend, Threads=Threads)
+    ShardEmbeddings = Embeddings(ImagePaths, Model, Preprocess, BatchSize, NumWorkers=NumWorkers)
+
+    # Only the rows of this shard are written
+    Output = np.memmap(OutputPath, dtype="float32", mode="r+", shape=Shape)
+    if ShardEmbeddings.shape[1]:
+        Output[Start:Start + len(ImagePaths)] = ShardEmbeddings
+    Output.flush()
+
+    return len(ImagePaths)
+
+# Extract image embeddings by several CPU processes
+# The torch intra-op threading scales poorly past a few cores, so on a CPU-only machine
+# we split ImagePaths into NumProcesses contiguous shards, and each worker process loads CLIP once
+# with ThreadsPerProcess threads and writes its shard into one memory-mapped output file.
+# If OutputPath is None, a temporary file is used and the embeddings are returned as an in-memory array.
+# Otherwise, the returned array is a read-only memory map of OutputPath (raw float32 with shape (N, Dim)).
+# Unreadable images get zero rows, just like Embeddings.
+# Backend is passed to LoadCLIPModel in each worker. For ONNX backends, export the model once before calling this.
+def ShardedEmbeddings(ImagePaths: list, ModelName: str = "ViT-B/32", NumProcesses: int = None,
+                      ThreadsPerProcess: int = None, BatchSize: int = 32, NumWorkers: int = 1,
+                      OutputPath: str = None, Backend: str = "torch") -> np.ndarray:
+    NumProcesses = max(1, min(NumProcesses or os.cpu_count(), len(ImagePaths)))
+    ThreadsPerProcess = ThreadsPerProcess or max(1, os.cpu_count() // NumProcesses)
+
+    # Find the embedding dimension, loading the model only for the unknown ones
+    Dim = EMBEDDING_DIMS.get(ModelName)
+    if Dim is None:
+        Dim = LoadCLIPModel(ModelName)[0].visual.output_dim
+    Shape = (len(ImagePaths), Dim)
+
+    TempOutput = OutputPath is None
+    if TempOutput:
+        Handle, OutputPath = tempfile.mkstemp(suffix=".f32")
+        os.close(Handle)
+
+    # Allocate the output file, the rows of failed shards stay zero
+    np.memmap(OutputPath, dtype="float32", mode="w+", shape=Shape).flush()
+
+    Shards = [Shard for Shard in np.array_split(np.arange(len(ImagePaths)), NumProcesses) if len(Shard)]
+    # Spawn fresh interpreters, since forking a process with torch threads running is unsafe
+    Context = multiprocessing.get_context("spawn")
+
+    try:
+        with ProcessPoolExecutor(max_workers=NumProcesses, mp_context=Context) as Executor:
+            Futures = [Executor.submit(EmbeddingsShardWorker, ImagePaths[Shard[0]:Shard[-1] + 1], int(Shard[0]),
+                                       OutputPath, Shape, ModelName, ThreadsPerProcess, BatchSize, NumWorkers, Backend)
+                       for Shard in Shards]
+
+            for Future, Shard in zip(Futures, Shards):
+                try:
+                    Future.result()
+                except Exception as e:
+                    LogMessage(f"Error embedding images {Shard[0]}-{Shard[-1]} in worker process. Error: {str(e)}", Type="ERROR")
+
+        Output = np.memmap(OutputPath, dtype="float32", mode="r", shape=Shape)
+        LogMessage(f"Embeddings of {len(ImagePaths)} images extracted by {NumProcesses} processes "
+                   f"with {ThreadsPerProcess} threads each.", Type="INFO")
+
+        if TempOutput:
+            Output = np.array(Output)
+
+        return Output
+
+    finally:
+        if TempOutput:
+            os.remove(OutputPath)
 
 # This program is used to compare the images in two given folders.
 # Simply speaking, assume we have two folders: Folder A and Folder B.
@@ -113,57 +1022,490 @@ def Embeddings(ImagePaths: list, Model, Preprocess, BatchSize: int = 32):
 # Threshold: The similarity threshold for determining whether two images are similar
 # TopK: The number of top similar images to retrieve for each image in folder B
 # SavePath: The path to save the comparison results in json format. If None, the results will not be saved to a file.
+# ModelName: The name of the CLIP model
+# CacheDir: The folder of the embedding cache. If None, all embeddings will be computed from scratch.
+# IndexType: The type of FAISS index for folder A, one of "Flat", "IVFFlat", "IVFPQ" and "HNSW" (see BuildIndex)
+# IndexParams: The parameters of the index, such as {"NList": 4096, "NProbe": 32}
+# RecallSample: The number of images in folder B used to estimate the recall of an approximate index. 0 to skip.
+# IndexPath: The path of the persisted index of folder A (see ReferenceIndex). If None, the index is built in memory.
+# HashPrefilter: "phash" or "dhash" to match the near-exact copies by perceptual hashes before CLIP. None to disable.
+# HashDistance: The maximum Hamming distance between the hashes of two matched images
+# The pairs matched by hashes are accepted by HashDistance alone, and Threshold only applies to the CLIP stage.
+# Their SimilarityScore is 1 - HammingDistance / 64 instead of a cosine similarity, e.g. 0.9375 for a distance of 4,
+# so tell the two stages apart by the HashDistance of each pair, which is -1 for the pairs found by CLIP.
+# Columnar: If True, return the pairs as a dict of arrays instead of a list of dicts (see ExtractDuplicates).
+# If SavePath ends with ".npz", the results are saved as compressed arrays instead of JSON.
 def FoldersCompare(FolderA: str = None, FolderB: str = None, 
-                   Threshold: float = 0.9, TopK: int = 5, SavePath: str = None) -> list:
+                   Threshold: float = 0.9, TopK: int = 5, SavePath: str = None,
+                   ModelName: str = "ViT-B/32", CacheDir: str = None,
+                   IndexType: str = "Flat", IndexParams: dict = None, RecallSample: int = 0,
+                   IndexPath: str = None, HashPrefilter: str = None, HashDistance: int = 4,
+                   Columnar: bool = False):
     # Check whether the folders exist
     if not os.path.exists(FolderA) or not os.path.exists(FolderB):
         LogMessage(f"One or both folders do not exist: {FolderA}, {FolderB}", Type="ERROR")
         return []
     
     # Obtain all image paths in folder A & folder B
-    ImageNamesA = GetFileNamesinDir(FolderA)
-    ImageNamesA = [name for name in ImageNamesA 
-                   if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'))]
-    ImagePathsA = [os.path.join(FolderA, Name) for Name in ImageNamesA]
-    ImageNamesB = GetFileNamesinDir(FolderB)
-    ImageNamesB = [name for name in ImageNamesB 
-                   if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'))]   
-    ImagePathsB = [os.path.join(FolderB, Name) for Name in ImageNamesB]
+    ImagePathsA = GetImagePaths(FolderA)
+    ImagePathsB = GetImagePaths(FolderB)
 
     if not ImagePathsA or not ImagePathsB:
         LogMessage("One or both folders contain no valid images.", Type="ERROR")
         return []
 
+    Duplicates = []
+
+    # Match the exact and near-exact copies by perceptual hashes first
+    # The images in folder B matched here will not go through CLIP
+    if HashPrefilter:
+        HashDuplicates = HashCompare(ImagePathsA, ImagePathsB, HashPrefilter, HashDistance)
+        Duplicates.extend(HashDuplicates)
+
+        Matched = {Pair["ImageInFolderB"] for Pair in HashDuplicates}
+        ImagePathsB = [ImagePath for ImagePath in ImagePathsB if ImagePath not in Matched]
+        LogMessage(f"{len(Matched)} images in folder B matched by {HashPrefilter}, {len(ImagePathsB)} left for CLIP.", Type="INFO")
+
+    if Columnar:
+        Duplicates = RecordsToColumns(Duplicates)
+
+    if ImagePathsB:
+        CLIPDuplicates = EmbeddingsCompare(ImagePathsA, ImagePathsB, Threshold, TopK, ModelName, CacheDir,
+                                           IndexType, IndexParams, RecallSample, IndexPath, Columnar)
+        if Columnar:
+            Duplicates = {Key: np.concatenate([Duplicates[Key], CLIPDuplicates[Key]]) for Key in Duplicates}
+        else:
+            Duplicates.extend(CLIPDuplicates)
+
+    if SavePath:
+        SaveDuplicates(Duplicates, SavePath)
+
+    return Duplicates
+
+# Compare the images by CLIP embeddings, which is the main stage of FoldersCompare
+# The variables are the same as FoldersCompare, and the similar pairs are returned without saving.
+def EmbeddingsCompare(ImagePathsA: list, ImagePathsB: list, Threshold: float = 0.9, TopK: int = 5,
+                      ModelName: str = "ViT-B/32", CacheDir: str = None,
+                      IndexType: str = "Flat", IndexParams: dict = None, RecallSample: int = 0,
+                      IndexPath: str = None, Columnar: bool = False):
     # Load CLIP model and preprocess function
-    Model, PreProcess = LoadCLIPModel()
+    Model, PreProcess = LoadCLIPModel(ModelName)
     # Extract embeddings for images in both folders
-    EmbeddingsA = Embeddings(ImagePathsA, Model, PreProcess)
-    EmbeddingsB = Embeddings(ImagePathsB, Model, PreProcess)
-    # Get the embedding dimension
-    Dim = EmbeddingsA.shape[1]
+    Cache = EmbeddingCache(CacheDir, ModelName) if CacheDir else None
+    EmbeddingsB = Embeddings(ImagePathsB, Model, PreProcess, Cache=Cache)
 
-    # Build FAISS index for images in folder A
-    Index = faiss.IndexFlatIP(Dim)
-    Index.add(EmbeddingsA)
+    # Drop the unreadable images, whose embeddings are zero
+    ValidB = np.flatnonzero(np.linalg.norm(EmbeddingsB, axis=1) > 0)
+    ImagePathsB, EmbeddingsB = [ImagePathsB[i] for i in ValidB], EmbeddingsB[ValidB]
+
+    Index, ImagePathsA, EmbeddingsA = PrepareIndex(ImagePathsA, Model, PreProcess, Cache, IndexType, IndexParams,
+                                                   IndexPath, ModelName)
+
+    if Index is None or not ImagePathsB:
+        LogMessage("One or both folders contain no readable images.", Type="ERROR")
+        return RecordsToColumns([]) if Columnar else []
 
     # Search for similar images in folder A for each image in folder B
     Score, Indices = Index.search(EmbeddingsB, TopK)
 
-    Duplicates = []
+    # Measure how much the approximate index misses
+    # The embeddings of a persisted index are not kept in memory, so the recall is not measured in that case
+    if RecallSample and IndexType != "Flat" and EmbeddingsA is not None:
+        EvaluateRecall(Index, EmbeddingsA, EmbeddingsB, TopK, RecallSample)
 
-    for i in tqdm.tqdm(range(len(ImagePathsB)), desc="Comparing images"):
-        for j in range(TopK):
-            if ImagePathsB[i] != ImagePathsA[Indices[i][j]] and Score[i][j] >= Threshold:
-                Duplicates.append({
-                    "ImageInFolderB": ImagePathsB[i],
-                    "ImageInFolderA": ImagePathsA[Indices[i][j]],
-                    "SimilarityScore": float(Score[i][j])
-                })
+    return ExtractDuplicates(Score, Indices, ImagePathsA, ImagePathsB, Threshold, Columnar)
 
-    if SavePath:
+# Embed the images in folder A and build their index, or bring the persisted index up to date if IndexPath is given
+# Return the index, the image paths indexed by the ids returned from the index, and the embeddings (None for persisted index).
+# The index is None if there is no readable image.
+def PrepareIndex(ImagePathsA: list, Model, Preprocess, Cache: EmbeddingCache = None,
+                 IndexType: str = "Flat", IndexParams: dict = None, IndexPath: str = None,
+                 ModelName: str = "ViT-B/32") -> tuple:
+    if IndexPath:
+        # Load the persisted index of folder A and bring it up to date with the folder
+        Reference = ReferenceIndex(IndexPath, IndexType, IndexParams, ModelName)
+        Reference.Sync(ImagePathsA, Model, Preprocess, Cache)
+        # The index returns the ids of the images instead of their positions
+        return Reference.Index, Reference.PathsById(), None
+
+    EmbeddingsA = Embeddings(ImagePathsA, Model, Preprocess, Cache=Cache)
+    ValidA = np.flatnonzero(np.linalg.norm(EmbeddingsA, axis=1) > 0)
+    ImagePathsA, EmbeddingsA = [ImagePathsA[i] for i in ValidA], EmbeddingsA[ValidA]
+    if not ImagePathsA:
+        return None, [], None
+
+    # Build FAISS index for images in folder A
+    return BuildIndex(EmbeddingsA, IndexType, **(IndexParams or {})), ImagePathsA, EmbeddingsA
+
+# Turn the search results into the similar pairs
+# The threshold, the -1 ids of approximate indexes and the pairs of the same image are all masked as array operations,
+# and the paths are only looked up for the pairs that survive.
+# If Columnar is True, the pairs are returned as arrays instead of a list of dicts:
+# {"ImageInFolderB": np.ndarray, "ImageInFolderA": np.ndarray, "SimilarityScore": np.ndarray, "HashDistance": np.ndarray}
+# HashDistance is -1 for all pairs found here, see HashCompare for the pairs matched by perceptual hashes.
+def ExtractDuplicates(Score: np.ndarray, Indices: np.ndarray, ImagePathsA: list, ImagePathsB: list,
+                      Threshold: float = 0.9, Columnar: bool = False):
+    # The id in folder A of each image in folder B if it is also in folder A, otherwise -1
+    PathToIdA = {ImagePath: Id for Id, ImagePath in enumerate(ImagePathsA) if ImagePath is not None}
+    SelfIds = np.array([PathToIdA.get(ImagePath, -1) for ImagePath in ImagePathsB], dtype="int64")
+
+    Mask = (Score >= Threshold) & (Indices >= 0) & (Indices != SelfIds[:, None])
+    RowsB, Columns = np.nonzero(Mask)
+    IdsA = Indices[RowsB, Columns]
+    Scores = Score[RowsB, Columns]
+
+    if Columnar:
+        return {
+            "ImageInFolderB": np.array(ImagePathsB, dtype=object)[RowsB],
+            "ImageInFolderA": np.array(ImagePathsA, dtype=object)[IdsA],
+            "SimilarityScore": Scores.astype("float32"),
+            "HashDistance": np.full(len(Scores), -1, dtype="int64")
+        }
+
+    return [{
+        "ImageInFolderB": ImagePathsB[i],
+        "ImageInFolderA": ImagePathsA[j],
+        "SimilarityScore": Score
+    } for i, j, Score in zip(RowsB.tolist(), IdsA.tolist(), Scores.tolist())]
+
+# Convert the similar pairs between the list of dicts and the columnar arrays
+# The records of the CLIP stage have no HashDistance, which is -1 in the columns.
+def RecordsToColumns(Records: list) -> dict:
+    return {
+        "ImageInFolderB": np.array([Pair["ImageInFolderB"] for Pair in Records], dtype=object),
+        "ImageInFolderA": np.array([Pair["ImageInFolderA"] for Pair in Records], dtype=object),
+        "SimilarityScore": np.array([Pair["SimilarityScore"] for Pair in Records], dtype="float32"),
+        "HashDistance": np.array([Pair.get("HashDistance", -1) for Pair in Records], dtype="int64")
+    }
+
+def ColumnsToRecords(Columns: dict) -> list:
+    Records = []
+    for ImageB, ImageA, Score, Distance in zip(Columns["ImageInFolderB"].tolist(), Columns["ImageInFolderA"].tolist(),
+                                               Columns["SimilarityScore"].tolist(), Columns["HashDistance"].tolist()):
+        Record = {"ImageInFolderB": ImageB, "ImageInFolderA": ImageA, "SimilarityScore": Score}
+        if Distance >= 0:
+            Record["HashDistance"] = Distance
+        Records.append(Record)
+
+    return Records
+
+# Save the similar pairs, either a list of dicts or columnar arrays
+# If SavePath ends with ".npz", the pairs are saved as compressed columnar arrays, which is much smaller than JSON.
+# They can be read back by np.load(SavePath). Otherwise, the pairs are saved as indented JSON.
+def SaveDuplicates(Duplicates, SavePath: str):
+    if SavePath.lower().endswith(".npz"):
+        Columns = Duplicates if isinstance(Duplicates, dict) else RecordsToColumns(Duplicates)
+        # Fixed-width strings, so that the file can be loaded without pickle
+        np.savez_compressed(SavePath,
+                            ImageInFolderB=Columns["ImageInFolderB"].astype(str),
+                            ImageInFolderA=Columns["ImageInFolderA"].astype(str),
+                            SimilarityScore=Columns["SimilarityScore"],
+                            HashDistance=Columns["HashDistance"])
+    else:
+        Records = ColumnsToRecords(Duplicates) if isinstance(Duplicates, dict) else Duplicates
         with open(SavePath, "w", encoding="utf-8") as outfile:
-            json.dump(Duplicates, outfile, indent=4, ensure_ascii=False)
-        LogMessage(f"Comparison results saved to: {SavePath}", Type="INFO")
+            json.dump(Records, outfile, indent=4, ensure_ascii=False)
+
+    LogMessage(f"Comparison results saved to: {SavePath}", Type="INFO")
+
+# Compare the images in two folders in the streaming mode
+# Folder A is embedded and indexed as usual, but folder B is embedded and searched in chunks of ChunkSize images,
+# and the similar pairs of each chunk are appended to SaveJsonlPath, one pair per line, as soon as the chunk is done.
+# So the memory stays flat however large folder B is, and the results of finished chunks survive an interruption.
+# The progress is recorded in SaveJsonlPath + ".progress": {"Processed": int, "Offset": int}
+# If Resume is True, a rerun cuts the JSONL file back to the recorded offset and continues with the next chunk.
+# The other variables are the same as FoldersCompare. Return the number of similar pairs written in this run.
+def FoldersCompareStream(FolderA: str = None, FolderB: str = None, SaveJsonlPath: str = None,
+                         Threshold: float = 0.9, TopK: int = 5, ChunkSize: int = 4096,
+                         ModelName: str = "ViT-B/32", CacheDir: str = None,
+                         IndexType: str = "Flat", IndexParams: dict = None, IndexPath: str = None,
+                         Resume: bool = True) -> int:
+    # Check whether the folders exist
+    if not os.path.exists(FolderA) or not os.path.exists(FolderB):
+        LogMessage(f"One or both folders do not exist: {FolderA}, {FolderB}", Type="ERROR")
+        return 0
+
+    ImagePathsA = GetImagePaths(FolderA)
+    ImagePathsB = GetImagePaths(FolderB)
+    if not ImagePathsA or not ImagePathsB:
+        LogMessage("One or both folders contain no valid images.", Type="ERROR")
+        return 0
+
+    # Read the progress of the last run
+    ProgressPath = SaveJsonlPath + ".progress"
+    Progress = {"Processed": 0, "Offset": 0}
+    if Resume and os.path.exists(ProgressPath) and os.path.exists(SaveJsonlPath):
+        with open(ProgressPath, "r", encoding="utf-8") as f:
+            Progress = json.load(f)
+        LogMessage(f"Resume comparison from image {Progress['Processed']}/{len(ImagePathsB)} in folder B.", Type="INFO")
+
+    Model, PreProcess = LoadCLIPModel(ModelName)
+    Cache = EmbeddingCache(CacheDir, ModelName) if CacheDir else None
+    Index, ImagePathsA, _ = PrepareIndex(ImagePathsA, Model, PreProcess, Cache, IndexType, IndexParams,
+                                         IndexPath, ModelName)
+    if Index is None:
+        LogMessage("Folder A contains no readable images.", Type="ERROR")
+        return 0
+
+    Count = 0
+    # Binary mode, so that the offsets are plain byte positions
+    with open(SaveJsonlPath, "r+b" if Progress["Processed"] else "wb") as outfile:
+        # Drop the pairs written after the last recorded chunk, they will be written again
+        outfile.truncate(Progress["Offset"])
+        outfile.seek(Progress["Offset"])
+
+        for Start in tqdm.tqdm(range(Progress["Processed"], len(ImagePathsB), ChunkSize), desc="Comparing chunks"):
+            Chunk = ImagePathsB[Start:Start + ChunkSize]
+            ChunkEmbeddings = Embeddings(Chunk, Model, PreProcess, Cache=Cache)
+
+            # Drop the unreadable images, whose embeddings are zero
+            Valid = np.flatnonzero(np.linalg.norm(ChunkEmbeddings, axis=1) > 0)
+            if len(Valid):
+                Score, Indices = Index.search(ChunkEmbeddings[Valid], TopK)
+                Duplicates = ExtractDuplicates(Score, Indices, ImagePathsA, [Chunk[i] for i in Valid], Threshold)
+                for Pair in Duplicates:
+                    outfile.write((json.dumps(Pair, ensure_ascii=False) + "\n").encode("utf-8"))
+                Count += len(Duplicates)
+
+            # Make sure the pairs are on disk before recording the progress
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            Progress = {"Processed": Start + len(Chunk), "Offset": outfile.tell()}
+            with open(ProgressPath + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(Progress, f)
+            os.replace(ProgressPath + ".tmp", ProgressPath)
+
+    # The chunks only appended to the journal of the cache, fold it into the index once
+    if Cache is not None:
+        Cache.Save()
+    LogMessage(f"{Count} similar pairs appended to: {SaveJsonlPath}", Type="INFO")
+
+    return Count
+
+# Decode one image into a small grayscale array for perceptual hashing
+# For JPEG images, Image.draft lets the decoder downscale while decoding, which is much faster than a full decode.
+def LoadHashPixels(ImagePath: str, Width: int, Height: int) -> np.ndarray:
+    try:
+        Img = Image.open(ImagePath)
+        Img.draft("L", (Width * 4, Height * 4))
+        Img = Img.convert("L").resize((Width, Height), Image.Resampling.LANCZOS)
+        return np.asarray(Img, dtype="float32")
+
+    except Exception as e:
+        LogMessage(f"Skip unreadable image: {ImagePath}. Error: {str(e)}", Type="WARNING")
+        return None
+
+# Compute the 64-bit perceptual hashes of images
+# "dhash": Compare each pixel with its right neighbor on a 9x8 thumbnail.
+# "phash": Compare the lowest 8x8 DCT coefficients of a 32x32 thumbnail with their median.
+# The images are decoded by NumWorkers threads, and then all hashes are computed in one vectorized NumPy pass.
+# Return the hashes as uint64 and a boolean mask of readable images.
+def PerceptualHashes(ImagePaths: list, HashType: str = "phash", NumWorkers: int = 4) -> tuple:
+    if HashType == "dhash":
+        Width, Height = 9, 8
+    elif HashType == "phash":
+        Width, Height = 32, 32
+    else:
+        raise ValueError(f"Unknown hash type: {HashType}")
+
+    with ThreadPoolExecutor(max_workers=max(1, NumWorkers)) as Executor:
+        PixelsList = list(tqdm.tqdm(Executor.map(lambda ImagePath: LoadHashPixels(ImagePath, Width, Height), ImagePaths),
+                                    total=len(ImagePaths), desc=f"Computing {HashType}"))
+
+    Valid = np.array([Pixels is not None for Pixels in PixelsList], dtype=bool)
+    Hashes = np.zeros(len(ImagePaths), dtype="uint64")
+    if not Valid.any():
+        return Hashes, Valid
+
+    Pixels = np.stack([Pixels for Pixels in PixelsList if Pixels is not None])
+    if HashType == "dhash":
+        Bits = Pixels[:, :, 1:] > Pixels[:, :, :-1]
+    else:
+        # Orthonormal DCT-II matrix, so that the 2D DCT of every image is C @ X @ C.T
+        k = np.arange(32)
+        C = np.sqrt(2 / 32) * np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / 64)
+        C[0] /= np.sqrt(2)
+        LowFreq = (C @ Pixels @ C.T)[:, :8, :8].reshape(len(Pixels), 64)
+        Bits = LowFreq > np.median(LowFreq, axis=1, keepdims=True)
+
+    # Pack 64 bits into one unsigned integer for each image
+    Hashes[Valid] = np.packbits(Bits.reshape(len(Pixels), 64), axis=1).view(">u8").ravel()
+
+    return Hashes, Valid
+
+# Count the set bits of each uint64
+def PopCount(Values: np.ndarray) -> np.ndarray:
+    return np.unpackbits(np.ascontiguousarray(Values, dtype="uint64").view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+# Find all pairs of hashes within MaxDistance bits
+# We use the multi-index lookup: split the 64 bits into MaxDistance + 1 chunks,
+# then two hashes within MaxDistance bits must be equal on at least one chunk (pigeonhole principle).
+# So we only verify the candidates sharing a chunk, instead of every pair.
+# Return the arrays of positions in HashesB, positions in HashesA and Hamming distances.
+def HashMatches(HashesA: np.ndarray, HashesB: np.ndarray, MaxDistance: int = 4) -> tuple:
+    NumChunks = MaxDistance + 1
+    Bounds = np.linspace(0, 64, NumChunks + 1).astype(int)
+
+    MatchesB, MatchesA, Distances = [], [], []
+    Seen = set()
+    for Low, High in zip(Bounds[:-1], Bounds[1:]):
+        Mask = np.uint64((1 << int(High - Low)) - 1)
+        ChunksA = (HashesA >> np.uint64(Low)) & Mask
+        ChunksB = (HashesB >> np.uint64(Low)) & Mask
+
+        # Group the positions in A by their chunk values
+        Order = np.argsort(ChunksA, kind="stable")
+        Values, Starts = np.unique(ChunksA[Order], return_index=True)
+        Ends = np.append(Starts[1:], len(Order))
+
+        # Locate the bucket of each hash in B
+        Slots = np.searchsorted(Values, ChunksB)
+        Slots[Slots == len(Values)] = 0
+        Hit = Values[Slots] == ChunksB if len(Values) else np.zeros(len(ChunksB), dtype=bool)
+
+        for i in np.flatnonzero(Hit):
+            Candidates = Order[Starts[Slots[i]]:Ends[Slots[i]]]
+            Dist = PopCount(HashesA[Candidates] ^ HashesB[i])
+            for j, d in zip(Candidates[Dist <= MaxDistance].tolist(), Dist[Dist <= MaxDistance].tolist()):
+                # The same pair may share several chunks
+                if (i, j) not in Seen:
+                    Seen.add((i, j))
+                    MatchesB.append(i)
+                    MatchesA.append(j)
+                    Distances.append(d)
+
+    return np.array(MatchesB, dtype="int64"), np.array(MatchesA, dtype="int64"), np.array(Distances, dtype="int64")
+
+# Compare the images in two lists by perceptual hashes
+# The similarity score of a pair is 1 - HammingDistance / 64, and the distance is also kept in the result.
+# The score is not a cosine similarity and is not compared with the Threshold of the CLIP stage.
+def HashCompare(ImagePathsA: list, ImagePathsB: list, HashType: str = "phash", MaxDistance: int = 4) -> list:
+    HashesA, ValidA = PerceptualHashes(ImagePathsA, HashType)
+    HashesB, ValidB = PerceptualHashes(ImagePathsB, HashType)
+    PositionsA, PositionsB = np.flatnonzero(ValidA), np.flatnonzero(ValidB)
+
+    MatchesB, MatchesA, Distances = HashMatches(HashesA[PositionsA], HashesB[PositionsB], MaxDistance)
+
+    Duplicates = []
+    for i, j, d in zip(PositionsB[MatchesB].tolist(), PositionsA[MatchesA].tolist(), Distances.tolist()):
+        if ImagePathsB[i] != ImagePathsA[j]:
+            Duplicates.append({
+                "ImageInFolderB": ImagePathsB[i],
+                "ImageInFolderA": ImagePathsA[j],
+                "SimilarityScore": 1 - d / 64,
+                "HashDistance": d
+            })
 
     return Duplicates
 
+# Union-find over the positions of images, with path compression and union by size
+# Merging two groups costs nearly O(1), instead of moving every member from one set to another.
+class UnionFind:
+    def __init__(self, Count: int):
+        self.Parent = list(range(Count))
+        self.Size = [1] * Count
+
+    # Find the root of the group that x belongs to
+    def Find(self, x: int) -> int:
+        Root = x
+        while self.Parent[Root] != Root:
+            Root = self.Parent[Root]
+        # Point every node on the path directly to the root
+        while self.Parent[x] != Root:
+            self.Parent[x], x = Root, self.Parent[x]
+
+        return Root
+
+    # Merge the groups of a and b
+    def Union(self, a: int, b: int):
+        RootA, RootB = self.Find(a), self.Find(b)
+        if RootA == RootB:
+            return
+        if self.Size[RootA] < self.Size[RootB]:
+            RootA, RootB = RootB, RootA
+        self.Parent[RootB] = RootA
+        self.Size[RootA] += self.Size[RootB]
+
+# Find the groups of similar images inside one folder
+# Compared with FoldersCompare(X, X), each image is embedded only once, and each similar pair is found only once.
+# The pairs are merged into connected components by union-find, so the output is the groups themselves:
+# [{"Representative": ImagePath, "Images": [ImagePath, ...]}, ...], sorted by the size of groups.
+# The representative is the largest file in the group, which usually has the best quality.
+
+# Variables:
+# Folder: The path of the folder
+# Threshold: The similarity threshold for determining whether two images are similar
+# TopK: If None, all pairs above the threshold are found by range search.
+#       Otherwise, only the TopK nearest neighbors of each image are considered, which is faster on large folders.
+# SavePath: The path to save the groups in json format. If None, the results will not be saved to a file.
+# The other variables are the same as FoldersCompare.
+def FolderDedup(Folder: str = None, Threshold: float = 0.9, TopK: int = None, SavePath: str = None,
+                ModelName: str = "ViT-B/32", CacheDir: str = None,
+                IndexType: str = "Flat", IndexParams: dict = None) -> list:
+    # Check whether the folder exists
+    if not os.path.exists(Folder):
+        LogMessage(f"Folder does not exist: {Folder}", Type="ERROR")
+        return []
+
+    # Obtain all image paths in the folder
+    ImagePaths = GetImagePaths(Folder)
+
+    # Load CLIP model and extract embeddings only once
+    Model, PreProcess = LoadCLIPModel(ModelName)
+    Cache = EmbeddingCache(CacheDir, ModelName) if CacheDir else None
+    FolderEmbeddings = Embeddings(ImagePaths, Model, PreProcess, Cache=Cache)
+
+    # Drop the unreadable images, whose embeddings are zero
+    Valid = np.flatnonzero(np.linalg.norm(FolderEmbeddings, axis=1) > 0)
+    ImagePaths, FolderEmbeddings = [ImagePaths[i] for i in Valid], FolderEmbeddings[Valid]
+    if len(ImagePaths) < 2:
+        LogMessage(f"Folder contains less than two readable images: {Folder}", Type="ERROR")
+        return []
+
+    Index = BuildIndex(FolderEmbeddings, IndexType, **(IndexParams or {}))
+    Groups = UnionFind(len(ImagePaths))
+
+    # Search the folder against itself in chunks, so the intermediate results stay small
+    ChunkSize = 4096
+    for Start in tqdm.tqdm(range(0, len(ImagePaths), ChunkSize), desc="Searching duplicates"):
+        Queries = FolderEmbeddings[Start:Start + ChunkSize]
+
+        if TopK is None:
+            # All neighbors above the threshold, given by the offsets Lims of each query
+            Lims, Score, Indices = Index.range_search(Queries, Threshold)
+            Rows = np.repeat(np.arange(len(Queries)), np.diff(Lims).astype("int64"))
+        else:
+            Score, Indices = Index.search(Queries, TopK)
+            Rows = np.repeat(np.arange(len(Queries)), TopK)
+            Score, Indices = Score.ravel(), Indices.ravel()
+
+        Rows = Rows + Start
+        # The neighbor lists of kNN and approximate search are not symmetric, so an edge found from either side is kept.
+        # The self matches and the -1 ids of missing neighbors are skipped, and UnionFind ignores the repeated edges.
+        Mask = (Score >= Threshold) & (Indices >= 0) & (Indices != Rows)
+        for a, b in zip(Rows[Mask].tolist(), Indices[Mask].tolist()):
+            Groups.Union(a, b)
+
+    # Collect the members of each connected component
+    Members = {}
+    for i in range(len(ImagePaths)):
+        Members.setdefault(Groups.Find(i), []).append(ImagePaths[i])
+
+    Clusters = []
+    for Images in Members.values():
+        if len(Images) < 2:
+            continue
+        Clusters.append({
+            "Representative": max(Images, key=os.path.getsize),
+            "Images": Images
+        })
+    Clusters.sort(key=lambda Cluster: len(Cluster["Images"]), reverse=True)
+
+    LogMessage(f"Total {len(Clusters)} groups of similar images found in {Folder}.", Type="INFO")
+
+    if SavePath:
+        with open(SavePath, "w", encoding="utf-8") as outfile:
+            json.dump(Clusters, outfile, indent=4, ensure_ascii=False)
+        LogMessage(f"Deduplication results saved to: {SavePath}", Type="INFO")
+
+    return Clusters
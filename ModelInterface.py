@@ -10,57 +10,419 @@ I used the OpenAI library during the implementation process,
 so please confirm that the model supports OpenAI interfaces.
 
 Function Table:
-ModelInterface(BaseURL: str, ModelName: str, APIToken: str) -- Initialize the model interface
+ModelInterface(BaseURL: str, ModelName: str, APIToken: str, TimeOut: int = 1800, MaxRetries: int = 5,
+RequestsPerMinute: int = None, TokensPerMinute: int = None, Cache: ResponseCache = None,
+ImageOptions: dict = None, Endpoints: list = None, Routing: str = "LeastOutstanding") -- Initialize the model interface
 ModelResponse(Prompt: str, ImageURLs: list, Temperature: float = 0.0, MaxTokens: int = 2048) -> dict 
 -- Get model response based on prompt and images
 ConcurrentModelAPI(Prompts: list, BatchImageURLs: list, Information: list, Temperature: float = 0.0, 
-MaxTokens: int = 2048, Concurrency: int, SaveJsonlPath: str) -> list 
+MaxTokens: int = 2048, Concurrency: int, SaveJsonlPath: str, Resume: bool = False, KeyField: str = None) -> list 
 -- Concurrently call interface for a batch of prompts and images
+AsyncModelResponse(Prompt: str, ImageURLs: list, Temperature: float = 0.0, MaxTokens: int = 2048, Client = None) -> dict
+-- Get model response based on prompt and images without blocking the event loop
+AsyncConcurrentModelAPI(Requests: iterable, Temperature: float = 0.0, MaxTokens: int = 2048,
+Concurrency: int = 256, SaveJsonlPath: str = None, Resume: bool = False, KeyField: str = None) -> list
+-- Call interface for a stream of requests in one event loop, with at most Concurrency requests in flight
+RunAsyncModelAPI(Requests: iterable, Temperature: float = 0.0, MaxTokens: int = 2048,
+Concurrency: int = 256, SaveJsonlPath: str = None, Resume: bool = False, KeyField: str = None) -> list
+-- Run AsyncConcurrentModelAPI from synchronous code
+IterConcurrentModelAPI(Requests: iterable, Temperature: float = 0.0, MaxTokens: int = 2048, Concurrency: int = 32,
+SaveJsonlPath: str = None, Resume: bool = False, KeyField: str = None, Ordered: bool = False,
+FlushInterval: float = 1.0, FsyncInterval: float = None) -> iterator
+-- Call interface for a stream of requests in threads and yield the records as they complete
+JsonlWriter(SavePath: str, FlushInterval: float = 1.0, FsyncInterval: float = None)
+-- Append records to a JSONL file from one background thread with batched flushes
+BuildRequests(Prompts: list, BatchImageURLs: list = [], Information: list = []) -> iterator
+-- Turn the lists of ConcurrentModelAPI into the requests of AsyncConcurrentModelAPI
+RequestKey(Prompt: str, ImageURLs: list, Information = None, KeyField: str = None) -> str
+-- Compute the stable key of a request, used to skip the finished requests when resuming
+LoadCompleted(SaveJsonlPath: str) -> dict -- Find the byte offsets of the successful records in a JSONL file by their keys
+ReadRecord(File, Offset: int) -> dict -- Read the record at a byte offset of a JSONL file opened in binary mode
+RateLimiter(RequestsPerMinute: int = None, TokensPerMinute: int = None)
+-- Client-side request and token budget per minute
+AdaptiveConcurrency(MaxConcurrency: int, MinConcurrency: int = 1)
+-- Concurrency limit which grows additively on success and halves on rate limit errors (AIMD)
+EndpointPool(Endpoints: list, Routing: str = "LeastOutstanding", EjectAfter: int = 3, EjectTime: float = 30.0)
+-- Route the requests across several OpenAI-compatible endpoints and eject the unhealthy ones for a while
 '''
 
+import os
 import json
+import time
+import random
+import queue
+import hashlib
+import asyncio
 import threading
 
 from openai import OpenAI
+from openai import AsyncOpenAI
+from openai import APIStatusError
+from openai import RateLimitError
+from openai import APIConnectionError
 from FileProcess import LogMessage
+from FileProcess import PrepareImagePayload
+from ResponseCache import CacheKey
+from ResponseCache import ResponseCache
 
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
 
 from tqdm import tqdm
 
+# The number of tokens counted for each image when estimating the token budget of a request
+# It is the cost of a 1024x1024 image in high detail mode of OpenAI models, other models differ a lot.
+IMAGE_TOKENS = 765
+
+# Estimate the tokens of a request before sending it, about 4 characters per token for text
+def EstimateTokens(Prompt: str = "", ImageURLs: list = [], MaxTokens: int = 2048) -> int:
+    return len(Prompt) // 4 + IMAGE_TOKENS * len(ImageURLs) + MaxTokens
+
+# Decide whether a failed request is worth retrying
+# Rate limits, server errors (5xx), connection errors and timeouts are transient,
+# while the other errors like bad requests or authentication errors will fail again.
+def IsRetryable(Error: Exception) -> bool:
+    if isinstance(Error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(Error, APIStatusError) and Error.status_code >= 500
+
+# Compute the waiting time before the next attempt
+# Exponential backoff with full jitter, so that the failed requests do not come back at the same moment.
+# The "Retry-After" header of the server is respected if it asks for a longer wait.
+def RetryDelay(Error: Exception, Attempt: int, BaseDelay: float = 1.0, MaxDelay: float = 60.0) -> float:
+    Delay = random.uniform(0, min(MaxDelay, BaseDelay * 2 ** Attempt))
+    if isinstance(Error, APIStatusError):
+        try:
+            Delay = max(Delay, min(MaxDelay, float(Error.response.headers.get("retry-after", 0))))
+        except (TypeError, ValueError):
+            pass
+    return Delay
+
+# Client-side request and token budget per minute
+# Each limit is a token bucket holding at most one minute of budget.
+# Reserve takes the budget of a request at once and returns how long the caller has to wait before sending it,
+# so the same limiter works for threads (time.sleep) and coroutines (asyncio.sleep).
+# A limit of None means no limit.
+class RateLimiter:
+    def __init__(self, RequestsPerMinute: int = None, TokensPerMinute: int = None):
+        self.Limits = {"Requests": RequestsPerMinute, "Tokens": TokensPerMinute}
+        self.Levels = {Name: float(Limit or 0) for Name, Limit in self.Limits.items()}
+        self.LastTime = time.monotonic()
+        self.Lock = threading.Lock()
+
+    # Refill the buckets according to the elapsed time, the lock must be held
+    def Refill(self):
+        Now = time.monotonic()
+        for Name, Limit in self.Limits.items():
+            if Limit:
+                self.Levels[Name] = min(Limit, self.Levels[Name] + (Now - self.LastTime) * Limit / 60)
+        self.LastTime = Now
+
+    # Take the budget of one request with the estimated tokens, return the seconds to wait before sending it
+    # The buckets may go below zero, which makes the following requests wait longer.
+    def Reserve(self, Tokens: int = 0) -> float:
+        with self.Lock:
+            self.Refill()
+            Wait = 0.0
+            for Name, Amount in (("Requests", 1), ("Tokens", Tokens)):
+                Limit = self.Limits[Name]
+                if Limit:
+                    self.Levels[Name] -= Amount
+                    Wait = max(Wait, -self.Levels[Name] * 60 / Limit)
+            return Wait
+
+    # Correct the token budget once the actual usage is known, a negative amount gives tokens back
+    def Adjust(self, Tokens: int):
+        with self.Lock:
+            if self.Limits["Tokens"]:
+                self.Refill()
+                self.Levels["Tokens"] = min(self.Limits["Tokens"], self.Levels["Tokens"] - Tokens)
+
+# Concurrency limit adapted by additive increase and multiplicative decrease (AIMD)
+# Every success raises the limit by 1 / Limit, which is about one more request per round of requests,
+# and a rate limit error halves the limit. Decreases within Cooldown seconds of the last one are ignored,
+# since the requests sent before the decrease will fail together.
+# Threads use Acquire / Release, while the asynchronous scheduler checks Limit itself and calls Record.
+class AdaptiveConcurrency:
+    def __init__(self, MaxConcurrency: int, MinConcurrency: int = 1, Cooldown: float = 2.0):
+        self.MaxConcurrency = MaxConcurrency
+        self.MinConcurrency = max(1, min(MinConcurrency, MaxConcurrency))
+        self.Cooldown = Cooldown
+        self.Value = float(MaxConcurrency)
+        self.InFlight = 0
+        self.LastDecrease = 0.0
+        self.Condition = threading.Condition()
+
+    # The number of requests allowed in flight now
+    @property
+    def Limit(self) -> int:
+        return max(self.MinConcurrency, int(self.Value))
+
+    # Update the limit with the outcome of a request: "Success", "RateLimited" or "Error"
+    def Record(self, Outcome: str):
+        with self.Condition:
+            if Outcome == "Success":
+                self.Value = min(self.MaxConcurrency, self.Value + 1 / self.Value)
+            elif Outcome == "RateLimited":
+                Now = time.monotonic()
+                if Now - self.LastDecrease >= self.Cooldown:
+                    self.Value = max(self.MinConcurrency, self.Value / 2)
+                    self.LastDecrease = Now
+                    LogMessage(f"Rate limited, concurrency decreased to {self.Limit}", Type="WARNING")
+            self.Condition.notify_all()
+
+    # Wait for a free slot under the current limit
+    def Acquire(self):
+        with self.Condition:
+            while self.InFlight >= self.Limit:
+                self.Condition.wait()
+            self.InFlight += 1
+
+    # Give back the slot and update the limit with the outcome of the request
+    def Release(self, Outcome: str = "Success"):
+        with self.Condition:
+            self.InFlight -= 1
+        self.Record(Outcome)
+
+# Append records to a JSONL file from one background thread
+# Opening the file and taking a lock for every record costs a lot of system calls at 100k+ records.
+# Here the file stays open, Write only serializes the record into a queue, and the thread writes whatever is queued at once.
+# FlushInterval: The longest time in seconds a written record may stay in the buffer of Python.
+# FsyncInterval: The longest time in seconds between forcing the file to disk by os.fsync.
+# If None, the file is only forced to disk when closed, which is enough unless the machine itself may crash.
+class JsonlWriter:
+    def __init__(self, SavePath: str, FlushInterval: float = 1.0, FsyncInterval: float = None):
+        self.SavePath = SavePath
+        self.FlushInterval = FlushInterval
+        self.FsyncInterval = FsyncInterval
+        self.Queue = queue.Queue()
+        self.File = open(SavePath, 'a', encoding='utf-8')
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    # Queue a record to be written
+    # The record is serialized on the calling thread, so that a record which cannot be serialized
+    # is reported and skipped alone instead of dropping the whole batch of the writer thread.
+    def Write(self, Record: dict):
+        try:
+            Line = json.dumps(Record, ensure_ascii=False) + '\n'
+        except Exception as e:
+            LogMessage(f"Error serializing record for jsonl file: {self.SavePath}. Error: {str(e)}", Type="ERROR")
+            return
+
+        self.Queue.put(Line)
+
+    # Write the queued records until Close is called
+    def Run(self):
+        LastFlush = LastFsync = time.monotonic()
+        Closing = False
+
+        while not Closing:
+            # Wait for a record, but wake up in time for the next flush
+            try:
+                Records = [self.Queue.get(timeout=self.FlushInterval)]
+            except queue.Empty:
+                Records = []
+            # Take all records queued meanwhile as one batch
+            while True:
+                try:
+                    Records.append(self.Queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in Records:
+                Closing = True
+            try:
+                self.File.writelines(Line for Line in Records if Line is not None)
+
+                Now = time.monotonic()
+                if Closing or Now - LastFlush >= self.FlushInterval:
+                    self.File.flush()
+                    LastFlush = Now
+                    if Closing or (self.FsyncInterval is not None and Now - LastFsync >= self.FsyncInterval):
+                        os.fsync(self.File.fileno())
+                        LastFsync = Now
+
+            except Exception as e:
+                LogMessage(f"Error writing to jsonl file: {self.SavePath}. Error: {str(e)}", Type="ERROR")
+
+    # Write the remaining records, force them to disk and close the file
+    def Close(self):
+        self.Queue.put(None)
+        self.Thread.join()
+        self.File.close()
+
+# One OpenAI-compatible endpoint in an EndpointPool
+# Outstanding: The number of requests in flight.
+# Latency: The exponentially weighted moving average of the latency of successful requests in seconds.
+# Failures: The number of consecutive failures, the endpoint is ejected until EjectedUntil once it reaches EjectAfter.
+class Endpoint:
+    def __init__(self, BaseURL: str, APIToken: str, Client: OpenAI):
+        self.BaseURL = BaseURL
+        self.APIToken = APIToken
+        self.Client = Client
+        # The asynchronous client is created for the event loop using it, see EndpointPool.CloseAsyncClients
+        self.AsyncClient = None
+        self.Outstanding = 0
+        self.Latency = None
+        self.Failures = 0
+        self.EjectedUntil = 0.0
+        self.Requests = 0
+        self.Errors = 0
+
+# Route the requests across several OpenAI-compatible endpoints, e.g. the replicas of a local inference server
+# Routing decides which healthy endpoint gets the next request:
+# "LeastOutstanding": The endpoint with the fewest requests in flight, the latency breaks the ties.
+# "EWMA": The endpoint with the lowest expected waiting time, i.e. the latency EWMA times the requests in flight plus one,
+# which sends less traffic to the slower replicas.
+# An endpoint failing EjectAfter times in a row with connection errors or server errors (5xx) is ejected for EjectTime seconds.
+# If all endpoints are ejected, the one coming back first is used, so the requests keep being tried.
+# Rate limit errors are not counted, since they are handled by AdaptiveConcurrency.
+class EndpointPool:
+    def __init__(self, Endpoints: list, Routing: str = "LeastOutstanding", EjectAfter: int = 3,
+                 EjectTime: float = 30.0, Alpha: float = 0.3):
+        if not Endpoints:
+            raise ValueError("At least one endpoint must be provided.")
+        if Routing not in ("LeastOutstanding", "EWMA"):
+            raise ValueError(f"Unknown routing: {Routing}")
+
+        self.Endpoints = Endpoints
+        self.Routing = Routing
+        self.EjectAfter = EjectAfter
+        self.EjectTime = EjectTime
+        self.Alpha = Alpha
+        self.Lock = threading.Lock()
+
+    # The routing score of an endpoint, the lower the better
+    def Score(self, Item: Endpoint) -> tuple:
+        # The endpoints without any latency yet are tried first
+        Latency = Item.Latency if Item.Latency is not None else 0.0
+        if self.Routing == "EWMA":
+            return (Latency * (Item.Outstanding + 1), Item.Outstanding)
+        return (Item.Outstanding, Latency)
+
+    # Choose an endpoint for a request and count the request as in flight
+    def Acquire(self) -> Endpoint:
+        with self.Lock:
+            Now = time.monotonic()
+            Healthy = [Item for Item in self.Endpoints if Item.EjectedUntil <= Now]
+            if Healthy:
+                Chosen = min(Healthy, key=self.Score)
+            else:
+                Chosen = min(self.Endpoints, key=lambda Item: Item.EjectedUntil)
+
+            Chosen.Outstanding += 1
+            Chosen.Requests += 1
+            return Chosen
+
+    # Finish a request on an endpoint, with its latency in seconds and its error if it failed
+    def Release(self, Item: Endpoint, Latency: float, Error: Exception = None):
+        with self.Lock:
+            Item.Outstanding -= 1
+
+            if Error is None:
+                Item.Failures = 0
+                Item.Latency = Latency if Item.Latency is None else self.Alpha * Latency + (1 - self.Alpha) * Item.Latency
+                return
+
+            Item.Errors += 1
+            if IsRetryable(Error) and not isinstance(Error, RateLimitError):
+                Item.Failures += 1
+                if Item.Failures >= self.EjectAfter:
+                    Item.EjectedUntil = time.monotonic() + self.EjectTime
+                    Item.Failures = 0
+                    LogMessage(f"Endpoint ejected for {self.EjectTime}s: {Item.BaseURL}. Error: {str(Error)}", Type="WARNING")
+
+    # Close the asynchronous clients created by the current event loop
+    async def CloseAsyncClients(self):
+        for Item in self.Endpoints:
+            if Item.AsyncClient is not None:
+                await Item.AsyncClient.close()
+                Item.AsyncClient = None
+
+    # Get the counters of all endpoints
+    def Stats(self) -> list:
+        with self.Lock:
+            return [{
+                "BaseURL": Item.BaseURL,
+                "Requests": Item.Requests,
+                "Errors": Item.Errors,
+                "Outstanding": Item.Outstanding,
+                "Latency": Item.Latency,
+                "Ejected": Item.EjectedUntil > time.monotonic()
+            } for Item in self.Endpoints]
+
+# Classify the outcome of a request for AdaptiveConcurrency
+def RequestOutcome(Error: Exception = None) -> str:
+    if Error is None:
+        return "Success"
+    return "RateLimited" if isinstance(Error, RateLimitError) else "Error"
+
 # Universal model calling interface
+# MaxRetries: The number of retries of a request after transient errors, with jittered exponential backoff.
+# The retries of the OpenAI library itself are turned off, so that they are not stacked with ours.
+# RequestsPerMinute / TokensPerMinute: The client-side budget shared by all requests of this interface,
+# set them a little below the limits of the provider. None means no limit.
+# Cache: The optional on-disk cache of responses. Only the requests with temperature 0 are served from it and stored in it,
+# since the other requests are expected to give different responses each time. See ResponseCache.Stats for the counters.
+# ImageOptions: The settings of PrepareImagePayload for the local image paths in ImageURLs,
+# e.g. {"MaxSide": 1024, "Format": "WEBP", "Quality": 80}. The defaults of PrepareImagePayload are used if not given.
+# Endpoints: Several OpenAI-compatible endpoints serving the same model, each a BaseURL string or a dict
+# {"BaseURL": str, "APIToken": str}, with APIToken used if a dict gives no token. BaseURL is not needed then.
+# The requests are routed across them by EndpointPool with Routing, and the retries may go to another endpoint.
+# A single BaseURL is a pool of one endpoint, so the code paths are the same.
 class ModelInterface:
-    def __init__(self, BaseURL: str = None, ModelName: str = None, APIToken: str = None, TimeOut: int = 1800):
+    def __init__(self, BaseURL: str = None, ModelName: str = None, APIToken: str = None, TimeOut: int = 1800,
+                 MaxRetries: int = 5, RequestsPerMinute: int = None, TokensPerMinute: int = None,
+                 Cache: ResponseCache = None, ImageOptions: dict = None, Endpoints: list = None,
+                 Routing: str = "LeastOutstanding"):
+        Endpoints = [dict(Item) if isinstance(Item, dict) else {"BaseURL": Item} for Item in Endpoints or []]
+        if not BaseURL and Endpoints:
+            BaseURL = Endpoints[0]["BaseURL"]
+
         self.BaseURL = BaseURL
         self.ModelName = ModelName
         self.APIToken = APIToken
         self.TimeOut = TimeOut
+        self.MaxRetries = MaxRetries
+        self.Limiter = RateLimiter(RequestsPerMinute, TokensPerMinute) if RequestsPerMinute or TokensPerMinute else None
+        self.Cache = Cache
+        self.ImageOptions = ImageOptions or {}
 
-        if not all([self.BaseURL, self.ModelName, self.APIToken]):
+        Endpoints = Endpoints or [{"BaseURL": self.BaseURL}]
+        for Item in Endpoints:
+            Item.setdefault("APIToken", self.APIToken)
+
+        if not all([self.BaseURL, self.ModelName] + [Item["BaseURL"] and Item["APIToken"] for Item in Endpoints]):
             raise ValueError("BaseURL, ModelName, and APIToken must be provided.")
-        
-        self.Client = OpenAI(
-            base_url = self.BaseURL,
-            api_key  = self.APIToken,
-            timeout  = self.TimeOut
-        )
-        
-        # Add a lock for thread-safe file writing
-        self.FileLock = threading.Lock()
 
+        self.Pool = EndpointPool([Endpoint(Item["BaseURL"], Item["APIToken"], OpenAI(
+            base_url    = Item["BaseURL"],
+            api_key     = Item["APIToken"],
+            timeout     = self.TimeOut,
+            max_retries = 0
+        )) for Item in Endpoints], Routing)
 
-    # Get model response based on prompt and images
-    
-    # Note that we use "user" role for simplicity
-    # If you want to use different roles like "system" or "assistant",
-    # Perhaps you need to modify this function accordingly
+        # The client of the first endpoint
+        self.Client = self.Pool.Endpoints[0].Client
 
-    # Here ImageURLs supports images that are publicly accessible via URLs or base64 encoded images
-    # The format of base64 encoded images should be like: "data:image/png;base64,{Base64String}"
-    def ModelResponse(self, Prompt: str = "", ImageURLs: list = [],
-                        Temperature: float = 0.0, MaxTokens: int = 2048          
-    ) -> dict:
+    # Create an asynchronous client for an endpoint with the same settings
+    # The connections of an asynchronous client belong to the event loop using it,
+    # so each run of AsyncConcurrentModelAPI creates its own clients and closes them at the end.
+    def CreateAsyncClient(self, Item: Endpoint = None) -> AsyncOpenAI:
+        Item = Item or self.Pool.Endpoints[0]
+        return AsyncOpenAI(
+            base_url    = Item.BaseURL,
+            api_key     = Item.APIToken,
+            timeout     = self.TimeOut,
+            max_retries = 0
+        )
+
+    # Construct the messages for the model from prompt and images
+    # Here we use the "user" role for simplicity
+    # In practice, you may want to use different roles based on your needs
+    def BuildMessages(self, Prompt: str = "", ImageURLs: list = []) -> list:
         # Construct contents for the model
         Contents = []
 
@@ -80,23 +442,33 @@ class ModelInterface:
                 }
             })
 
-        # Construct message for the model
-        # Here we use the "user" role for simplicity
-        # In practice, you may want to use different roles based on your needs
         Message = {
             "role": "user",
             "content": Contents
         }
-        
-        # Call the model API
-        Response = self.Client.chat.completions.create(
-            model = self.ModelName,
-            messages = [Message],
-            temperature = Temperature,
-            max_tokens = MaxTokens
-        )
 
-        # Extract the model's reply, including model reponse and thinking process if available
+        return [Message]
+
+    # Decide whether an entry of ImageURLs is a local image path rather than a URL
+    def IsLocalImage(self, ImageURL: str) -> bool:
+        return not ImageURL.startswith(("http://", "https://", "data:"))
+
+    # Replace the local image paths in ImageURLs by their downsized and re-encoded payloads
+    # The other entries are kept as they are. A local image which cannot be read fails the request.
+    def PrepareImageURLs(self, ImageURLs: list = []) -> list:
+        Prepared = []
+        for ImageURL in ImageURLs:
+            if self.IsLocalImage(ImageURL):
+                Payload = PrepareImagePayload(ImageURL, **self.ImageOptions)
+                if Payload is None:
+                    raise ValueError(f"Cannot prepare the image: {ImageURL}")
+                ImageURL = Payload
+            Prepared.append(ImageURL)
+
+        return Prepared
+
+    # Extract the model's reply, including model reponse and thinking process if available
+    def ExtractReply(self, Response) -> dict:
         try:
             ModelReply = Response.choices[0].message.content
             ModelReasoning = None
@@ -115,44 +487,471 @@ class ModelInterface:
                 "Reasoning": None
             }
 
+
+    # Get model response based on prompt and images
+    
+    # Note that we use "user" role for simplicity
+    # If you want to use different roles like "system" or "assistant",
+    # Perhaps you need to modify this function accordingly
+
+    # Here ImageURLs supports images that are publicly accessible via URLs or base64 encoded images
+    # The format of base64 encoded images should be like: "data:image/png;base64,{Base64String}"
+    # Local image paths are supported as well, they are downsized and encoded by PrepareImagePayload with ImageOptions.
+
+    # Transient errors are retried up to MaxRetries times, and the last error is raised if all attempts fail.
+    # Concurrency: The adaptive concurrency limit of ConcurrentModelAPI, which every attempt has to pass.
+    def ModelResponse(self, Prompt: str = "", ImageURLs: list = [],
+                        Temperature: float = 0.0, MaxTokens: int = 2048,
+                        Concurrency: AdaptiveConcurrency = None
+    ) -> dict:
+        # Serve the deterministic request from the cache if it has been answered before
+        Key = self.CachedKey(Prompt, ImageURLs, Temperature, MaxTokens)
+        if Key:
+            Result = self.Cache.Get(Key)
+            if Result is not None:
+                return Result
+
+        # The local images are only read and encoded when the request is really sent
+        ImageURLs = self.PrepareImageURLs(ImageURLs)
+
+        Messages = self.BuildMessages(Prompt, ImageURLs)
+        Tokens = EstimateTokens(Prompt, ImageURLs, MaxTokens)
+
+        for Attempt in range(self.MaxRetries + 1):
+            # Wait for the budget of this minute
+            if self.Limiter:
+                time.sleep(self.Limiter.Reserve(Tokens))
+
+            if Concurrency:
+                Concurrency.Acquire()
+            Item = self.Pool.Acquire()
+            StartTime = time.monotonic()
+            try:
+                # Call the model API
+                Response = Item.Client.chat.completions.create(
+                    model = self.ModelName,
+                    messages = Messages,
+                    temperature = Temperature,
+                    max_tokens = MaxTokens
+                )
+
+            except Exception as e:
+                self.Pool.Release(Item, time.monotonic() - StartTime, e)
+                if Concurrency:
+                    Concurrency.Release(RequestOutcome(e))
+                if not IsRetryable(e) or Attempt == self.MaxRetries:
+                    raise
+
+                Delay = RetryDelay(e, Attempt)
+                LogMessage(f"Request failed (attempt {Attempt + 1}/{self.MaxRetries + 1}), retry in {Delay:.1f}s. "
+                           f"Error: {str(e)}", Type="WARNING")
+                time.sleep(Delay)
+                continue
+
+            self.Pool.Release(Item, time.monotonic() - StartTime)
+            if Concurrency:
+                Concurrency.Release()
+            self.RecordUsage(Response, Tokens)
+
+            return self.StoreReply(Key, self.ExtractReply(Response))
+
+    # Compute the cache key of a request, or None if the request should not use the cache
+    # A local image is identified by its path, modification time, size and ImageOptions instead of its payload,
+    # so that a cache hit needs no reading or encoding of the image.
+    def CachedKey(self, Prompt: str, ImageURLs: list, Temperature: float, MaxTokens: int) -> str:
+        if self.Cache is None or Temperature != 0:
+            return None
+
+        Identities = []
+        for ImageURL in ImageURLs:
+            if self.IsLocalImage(ImageURL):
+                try:
+                    Stat = os.stat(ImageURL)
+                    ImageURL = json.dumps(["file", os.path.abspath(ImageURL), Stat.st_mtime_ns, Stat.st_size,
+                                           self.ImageOptions], sort_keys=True)
+                except OSError:
+                    # The request will fail when the image is prepared, and a failed reply is never stored
+                    pass
+            Identities.append(ImageURL)
+
+        return CacheKey(self.ModelName, Prompt, Identities, Temperature, MaxTokens)
+
+    # Store a reply in the cache if it has a key, the replies failed to extract are not stored
+    def StoreReply(self, Key: str, Result: dict) -> dict:
+        if Key and Result["Response"] is not None:
+            self.Cache.Put(Key, Result)
+        return Result
+
+    # Correct the token budget by the actual usage reported in the response
+    def RecordUsage(self, Response, EstimatedTokens: int):
+        Usage = getattr(Response, "usage", None)
+        if self.Limiter and Usage is not None and Usage.total_tokens is not None:
+            self.Limiter.Adjust(Usage.total_tokens - EstimatedTokens)
+
+    # Get model response based on prompt and images without blocking the event loop
+    # The variables and the returned dict are the same as ModelResponse.
+    # Client: The asynchronous client to use, bypassing the endpoint pool. If not given, the request is routed by the pool,
+    # and the client of each endpoint is created on first use, which should then only be used in one event loop.
+    # Concurrency: The adaptive concurrency limit of AsyncConcurrentModelAPI, which is told the outcome of every attempt.
+    async def AsyncModelResponse(self, Prompt: str = "", ImageURLs: list = [],
+                                 Temperature: float = 0.0, MaxTokens: int = 2048, Client: AsyncOpenAI = None,
+                                 Concurrency: AdaptiveConcurrency = None) -> dict:
+        # The cache is a local SQLite database, which is fast enough to query in the event loop
+        Key = self.CachedKey(Prompt, ImageURLs, Temperature, MaxTokens)
+        if Key:
+            Result = self.Cache.Get(Key)
+            if Result is not None:
+                return Result
+
+        # Decoding and resizing the local images would block the event loop, so they are done in a thread
+        if any(self.IsLocalImage(ImageURL) for ImageURL in ImageURLs):
+            ImageURLs = await asyncio.to_thread(self.PrepareImageURLs, ImageURLs)
+
+        Messages = self.BuildMessages(Prompt, ImageURLs)
+        Tokens = EstimateTokens(Prompt, ImageURLs, MaxTokens)
+
+        for Attempt in range(self.MaxRetries + 1):
+            if self.Limiter:
+                await asyncio.sleep(self.Limiter.Reserve(Tokens))
+
+            Item = self.Pool.Acquire() if Client is None else None
+            if Item is not None and Item.AsyncClient is None:
+                Item.AsyncClient = self.CreateAsyncClient(Item)
+            StartTime = time.monotonic()
+            try:
+                Response = await (Client or Item.AsyncClient).chat.completions.create(
+                    model = self.ModelName,
+                    messages = Messages,
+                    temperature = Temperature,
+                    max_tokens = MaxTokens
+                )
+
+            except Exception as e:
+                if Item is not None:
+                    self.Pool.Release(Item, time.monotonic() - StartTime, e)
+                if Concurrency:
+                    Concurrency.Record(RequestOutcome(e))
+                if not IsRetryable(e) or Attempt == self.MaxRetries:
+                    raise
+
+                Delay = RetryDelay(e, Attempt)
+                LogMessage(f"Request failed (attempt {Attempt + 1}/{self.MaxRetries + 1}), retry in {Delay:.1f}s. "
+                           f"Error: {str(e)}", Type="WARNING")
+                await asyncio.sleep(Delay)
+                continue
+
+            if Item is not None:
+                self.Pool.Release(Item, time.monotonic() - StartTime)
+            if Concurrency:
+                Concurrency.Record("Success")
+            self.RecordUsage(Response, Tokens)
+
+            return self.StoreReply(Key, self.ExtractReply(Response))
+
     # Concurrently call interface for a batch of prompts and images to improve efficiency
     # Here we provide an output file interface here to save the results to a jsonl file 
     # The writing process is real-time and appended to avoid data loss.
+    # All records are kept in the returned list, use IterConcurrentModelAPI for the batches too large for memory.
+    # Concurrency is the upper limit, the number of requests in flight is adapted to the rate limit errors of the server.
+    # A request failing after all retries does not abort the batch,
+    # its record gets "Response": None and an "Error" message instead.
+
+    # Every record carries a stable "Key" of its request, see RequestKey.
+    # Resume: If True, the requests whose keys already have successful records in SaveJsonlPath are not sent again,
+    # their saved records are returned instead. The failed records are retried, so an interrupted run can simply be started again.
+    # KeyField: The field of each Information dict used as the key, e.g. "ID". The key is a hash of the request if not given.
     def ConcurrentModelAPI(self, 
         Prompts: list = [], BatchImageURLs: list = [], Information: list = [],
         Temperature: float = 0.0, MaxTokens: int = 2048, 
-        Concurrency: int = 32, SaveJsonlPath: str = None) -> list:
+        Concurrency: int = 32, SaveJsonlPath: str = None,
+        Resume: bool = False, KeyField: str = None) -> list:
+
+        Requests = list(BuildRequests(Prompts, BatchImageURLs, Information))
+        return list(self.IterConcurrentModelAPI(Requests, Temperature, MaxTokens, Concurrency, SaveJsonlPath, Resume, KeyField))
+
+    # Call interface for a stream of requests and yield the records one by one
+    # Unlike ConcurrentModelAPI, the records are not kept in memory, and the requests are taken from Requests
+    # only when there is room, so neither the inputs nor the outputs of a huge batch are materialized.
+    # Requests: Any iterable of dicts {"Prompt": str, "ImageURLs": list, "Information": any, "Key": str},
+    # the same as AsyncConcurrentModelAPI. Use BuildRequests to convert the lists of ConcurrentModelAPI.
+    # Ordered: If True, the records are yielded in the order of Requests, otherwise in the order of completion.
+    # A slow request then holds back the following records, and at most 2 * Concurrency of them are buffered.
+    # FlushInterval / FsyncInterval: See JsonlWriter, which writes all records to SaveJsonlPath in one thread.
+    # The other variables are the same as ConcurrentModelAPI.
+    def IterConcurrentModelAPI(self, Requests = (),
+        Temperature: float = 0.0, MaxTokens: int = 2048,
+        Concurrency: int = 32, SaveJsonlPath: str = None,
+        Resume: bool = False, KeyField: str = None, Ordered: bool = False,
+        FlushInterval: float = 1.0, FsyncInterval: float = None):
+
+        Adaptive = AdaptiveConcurrency(Concurrency)
+        Completed = LoadCompleted(SaveJsonlPath) if Resume and SaveJsonlPath else {}
+        # The records of the previous run are read back one by one when they are yielded
+        CompletedFile = open(SaveJsonlPath, 'rb') if Completed else None
+        Writer = JsonlWriter(SaveJsonlPath, FlushInterval, FsyncInterval) if SaveJsonlPath else None
+        # The requests in flight plus the records waiting for their turn in Ordered mode
+        Window = 2 * Concurrency
+
+        # Take a finished record out of the buffer, which holds the offsets of the records of the previous run
+        def Take(idx: int) -> dict:
+            Record = Finished.pop(idx)
+            return ReadRecord(CompletedFile, Record) if isinstance(Record, int) else Record
+
+        # Run one request in a worker thread, build its record and write it at once,
+        # so that the record is saved even if the consumer of the generator is slow or stops early
+        def Process(Request: dict, Key: str) -> dict:
+            try:
+                Result = self.ModelResponse(Request.get("Prompt", ""), Request.get("ImageURLs") or [],
+                                            Temperature, MaxTokens, Adaptive)
+            except Exception as e:
+                LogMessage(f"Request failed: {str(e)}", Type="ERROR")
+                Result = FailedRecord(e)
+
+            # Add additional information if provided
+            if "Information" in Request:
+                Result["Information"] = Request["Information"]
+            Result["Key"] = Key
+
+            if Writer:
+                Writer.Write(Result)
+            return Result
+
+        Executor = ThreadPoolExecutor(max_workers=Concurrency)
+        ProgressBar = tqdm(total=len(Requests) if hasattr(Requests, "__len__") else None, desc="Processing")
+        FutureToIdx = {}
+        # The finished records by their indexes, and the index of the next record to yield in Ordered mode
+        Finished = {}
+        NextIdx = 0
+        Skipped = 0
+
+        try:
+            RequestIter = enumerate(Requests)
+            Exhausted = False
+
+            while not Exhausted or FutureToIdx or Finished:
+                # Take new requests while there is room in the window
+                while not Exhausted and len(FutureToIdx) + len(Finished) < Window:
+                    Item = next(RequestIter, None)
+                    if Item is None:
+                        Exhausted = True
+                        break
+
+                    idx, Request = Item
+                    Key = Request.get("Key") or RequestKey(Request.get("Prompt", ""), Request.get("ImageURLs") or [],
+                                                           Request.get("Information"), KeyField)
+                    # Skip the request finished by a previous run
+                    if Key in Completed:
+                        Finished[idx] = Completed[Key]
+                        Skipped += 1
+                    else:
+                        FutureToIdx[Executor.submit(Process, Request, Key)] = idx
+
+                # Wait for at least one request to finish, unless there are records ready to yield
+                if FutureToIdx and not (Finished and (not Ordered or NextIdx in Finished)):
+                    Done, _ = wait(FutureToIdx.keys(), return_when=FIRST_COMPLETED)
+                    for Future in Done:
+                        Finished[FutureToIdx.pop(Future)] = Future.result()
+
+                # Yield the records which are ready
+                if Ordered:
+                    while NextIdx in Finished:
+                        ProgressBar.update(1)
+                        yield Take(NextIdx)
+                        NextIdx += 1
+                else:
+                    for idx in list(Finished):
+                        ProgressBar.update(1)
+                        yield Take(idx)
+
+        finally:
+            # Drop the requests not started yet if the caller stops early,
+            # and wait for those in flight, so that their records are written before the writer is closed
+            Executor.shutdown(wait=True, cancel_futures=True)
+            ProgressBar.close()
+            if Writer:
+                Writer.Close()
+            if CompletedFile:
+                CompletedFile.close()
+
+            if Skipped:
+                LogMessage(f"Resume from {SaveJsonlPath}: {Skipped} requests skipped as finished", Type="INFO")
+            if self.Cache:
+                LogMessage(f"Response cache: {self.Cache.Stats()}", Type="INFO")
+            if len(self.Pool.Endpoints) > 1:
+                LogMessage(f"Endpoints: {self.Pool.Stats()}", Type="INFO")
+
+    # Call interface for a stream of requests in one event loop
+    # ConcurrentModelAPI blocks one thread per request, which does not scale to hundreds of requests in flight.
+    # Here all requests share one thread, and a semaphore keeps at most Concurrency of them in flight.
+    # Requests: Any iterable of dicts {"Prompt": str, "ImageURLs": list, "Information": any}, where
+    # "ImageURLs" and "Information" are optional. It is consumed lazily, only when there is a free slot,
+    # so a generator over a huge batch is never materialized. Use BuildRequests to convert the lists of ConcurrentModelAPI.
+    # The results are the same records as ConcurrentModelAPI, in the order of completion.
+    # Like ConcurrentModelAPI, the requests in flight are adapted to the rate limit errors under Concurrency,
+    # and a failed request gives a record with an "Error" message instead of aborting the batch.
+    # Resume and KeyField are the same as ConcurrentModelAPI, and a request may also give its own "Key".
+    async def AsyncConcurrentModelAPI(self, Requests = (),
+        Temperature: float = 0.0, MaxTokens: int = 2048,
+        Concurrency: int = 256, SaveJsonlPath: str = None,
+        Resume: bool = False, KeyField: str = None) -> list:
 
         # Store all results
         Results = []
+        Completed = LoadCompleted(SaveJsonlPath) if Resume and SaveJsonlPath else {}
+        CompletedFile = open(SaveJsonlPath, 'rb') if Completed else None
+        Semaphore = asyncio.Semaphore(Concurrency)
+        Adaptive = AdaptiveConcurrency(Concurrency)
+        Pending = set()
+        Errors = []
+        Writer = JsonlWriter(SaveJsonlPath) if SaveJsonlPath else None
+
+        # Process one request and release its slot when it is done
+        async def Process(Request: dict, Key: str):
+            try:
+                Result = await self.AsyncModelResponse(Request.get("Prompt", ""), Request.get("ImageURLs") or [],
+                                                       Temperature, MaxTokens, Concurrency=Adaptive)
+            except Exception as e:
+                LogMessage(f"Request failed: {str(e)}", Type="ERROR")
+                Result = FailedRecord(e)
+            finally:
+                Semaphore.release()
+
+            # Add additional information if provided
+            if "Information" in Request:
+                Result["Information"] = Request["Information"]
+            Result["Key"] = Key
+
+            Results.append(Result)
+            ProgressBar.update(1)
+
+            # The writer thread does the file I/O, so the event loop is never blocked by it
+            if Writer:
+                Writer.Write(Result)
+
+        # Forget a finished request and keep its error
+        def Finish(Task: asyncio.Task):
+            Pending.discard(Task)
+            if not Task.cancelled() and Task.exception() is not None:
+                Errors.append(Task.exception())
+
+        ProgressBar = tqdm(total=len(Requests) if hasattr(Requests, "__len__") else None, desc="Processing")
+        # The clients left by another event loop cannot be used in this one
+        for Item in self.Pool.Endpoints:
+            Item.AsyncClient = None
+        try:
+            for Request in Requests:
+                Key = Request.get("Key") or RequestKey(Request.get("Prompt", ""), Request.get("ImageURLs") or [],
+                                                       Request.get("Information"), KeyField)
+                # Skip the request finished by a previous run
+                if Key in Completed:
+                    Results.append(ReadRecord(CompletedFile, Completed[Key]))
+                    ProgressBar.update(1)
+                    continue
+
+                # Wait for a free slot before taking the next request
+                await Semaphore.acquire()
+                # Wait until the requests in flight fall below the adaptive limit
+                while len(Pending) >= Adaptive.Limit:
+                    await asyncio.wait(Pending, return_when=asyncio.FIRST_COMPLETED)
+                # Raise the unexpected error of a finished task as soon as possible
+                if Errors:
+                    raise Errors[0]
+
+                Task = asyncio.create_task(Process(Request, Key))
+                Pending.add(Task)
+                Task.add_done_callback(Finish)
+
+            if Pending:
+                await asyncio.gather(*Pending)
+
+        finally:
+            for Task in Pending:
+                Task.cancel()
+            ProgressBar.close()
+            await self.Pool.CloseAsyncClients()
+            if Writer:
+                Writer.Close()
+            if CompletedFile:
+                CompletedFile.close()
+
+        if self.Cache:
+            LogMessage(f"Response cache: {self.Cache.Stats()}", Type="INFO")
+        if len(self.Pool.Endpoints) > 1:
+            LogMessage(f"Endpoints: {self.Pool.Stats()}", Type="INFO")
+
+        return Results
+
+    # Run AsyncConcurrentModelAPI from synchronous code
+    # The variables are the same as AsyncConcurrentModelAPI. It must not be called inside a running event loop.
+    def RunAsyncModelAPI(self, Requests = (),
+        Temperature: float = 0.0, MaxTokens: int = 2048,
+        Concurrency: int = 256, SaveJsonlPath: str = None,
+        Resume: bool = False, KeyField: str = None) -> list:
+        return asyncio.run(self.AsyncConcurrentModelAPI(Requests, Temperature, MaxTokens, Concurrency, SaveJsonlPath,
+                                                        Resume, KeyField))
+
+# Build the record of a request which failed after all retries
+def FailedRecord(Error: Exception) -> dict:
+    return {
+        "Response": None,
+        "Reasoning": None,
+        "Error": f"{type(Error).__name__}: {str(Error)}"
+    }
+
+# Turn the lists of ConcurrentModelAPI into the requests of AsyncConcurrentModelAPI
+# The requests are generated one by one, and "Information" is only added when it is provided for the prompt.
+def BuildRequests(Prompts: list = [], BatchImageURLs: list = [], Information: list = []):
+    for idx, Prompt in enumerate(Prompts):
+        Request = {
+            "Prompt": Prompt,
+            "ImageURLs": BatchImageURLs[idx] if idx < len(BatchImageURLs) else []
+        }
+        if Information and idx < len(Information):
+            Request["Information"] = Information[idx]
+        yield Request
+
+# Compute the stable key of a request
+# If KeyField is given and Information is a dict containing it, the key is that field, e.g. the ID of a sample.
+# Otherwise the key is the SHA-256 hash of the prompt, the images and the information, which stays the same between runs.
+def RequestKey(Prompt: str = "", ImageURLs: list = [], Information = None, KeyField: str = None) -> str:
+    if KeyField and isinstance(Information, dict) and KeyField in Information:
+        return str(Information[KeyField])
+
+    Data = json.dumps([Prompt, ImageURLs, Information], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(Data.encode("utf-8")).hexdigest()
+
+# Find the successful records in a JSONL file written by ConcurrentModelAPI
+# Return the byte offset of the record of each "Key". Only the offsets are kept, since the records with long reasoning
+# of a 100k-item run would not fit in memory, read them back by ReadRecord when they are needed.
+# The records without a key, with an "Error" or without a response are left out, so that their requests are sent again.
+# A broken last line left by a crash is ignored, and a newline is appended after it,
+# so that the records of the resumed run start on their own lines.
+def LoadCompleted(SaveJsonlPath: str) -> dict:
+    Completed = {}
+    if not SaveJsonlPath or not os.path.exists(SaveJsonlPath):
+        return Completed
+
+    with open(SaveJsonlPath, 'rb+') as F:
+        if F.seek(0, os.SEEK_END) > 0:
+            F.seek(-1, os.SEEK_END)
+            if F.read(1) != b'\n':
+                F.write(b'\n')
+
+    Offset = 0
+    with open(SaveJsonlPath, 'rb') as F:
+        for Line in F:
+            try:
+                Record = json.loads(Line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                Record = None
+
+            if isinstance(Record, dict) and Record.get("Key") and "Error" not in Record and Record.get("Response") is not None:
+                Completed[Record["Key"]] = Offset
+            Offset += len(Line)
+
+    return Completed
 
-        with ThreadPoolExecutor(max_workers=Concurrency) as Executor:
-            FutureToIdx = {}
-            # Submit tasks to the executor
-            for idx, Prompt in enumerate(Prompts):
-                ImageURLs = BatchImageURLs[idx] if idx < len(BatchImageURLs) else []
-                Future = Executor.submit(self.ModelResponse, Prompt, ImageURLs, Temperature, MaxTokens)
-                FutureToIdx[Future] = idx
-
-            # Process completed futures
-            for Future in tqdm(as_completed(FutureToIdx.keys()), total=len(FutureToIdx), desc="Processing"):
-                Result = Future.result()
-                idx = FutureToIdx[Future]
-                
-                # Add additional information if provided
-                if Information and idx < len(Information):
-                    Result["Information"] = Information[idx]
-
-                Results.append(Result)
-
-                # Save to jsonl file if path is provided (thread-safe)
-                if SaveJsonlPath:
-                    try:
-                        with self.FileLock:
-                            with open(SaveJsonlPath, 'a', encoding='utf-8') as F:
-                                F.write(json.dumps(Result, ensure_ascii=False) + '\n')
-
-                    except Exception as e:
-                        LogMessage(f"Error writing to jsonl file: {str(e)}", Type="ERROR")
-
-        return Results
\ No newline at end of file
+# Read the record at a byte offset found by LoadCompleted, File is the JSONL file opened in binary mode
+def ReadRecord(File, Offset: int) -> dict:
+    File.seek(Offset)
+    return json.loads(File.readline())
@@ -0,0 +1,146 @@
+'''
+Copyright(c) Liang Yiyan, Pekin University, 2026. All rights reserved.
+
+This program keeps the responses of the model in a SQLite database,
+so that re-running the same prompts and images after a crash or a change of the downstream parsing
+does not pay for the same requests again.
+Each response is keyed by the hash of model name, prompt, images, temperature and max tokens.
+Only deterministic requests (temperature 0) are worth caching, which is decided by ModelInterface.
+When the cache grows over its size limit, the least recently used responses are evicted down to 90% of the limit.
+
+Function Table:
+CacheKey(ModelName: str, Prompt: str, ImageURLs: list, Temperature: float, MaxTokens: int) -> str
+-- Compute the key of a request
+ResponseCache(CachePath: str = CACHE_FILE, MaxSize: int = 1073741824) -- Initialize the response cache
+ResponseCache.Get(Key: str) -> dict -- Get the cached response of a request
+ResponseCache.Put(Key: str, Result: dict) -> None -- Store the response of a request
+ResponseCache.Stats() -> dict -- Get the hit / miss counters and the size of the cache
+'''
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from FileProcess import LogMessage
+
+# The default database file of the response cache
+CACHE_FILE = "ResponseCache.db"
+# The fraction of MaxSize the cache is evicted down to, so that eviction does not run again on every Put
+LOW_WATER = 0.9
+# The number of hits whose access times are kept in memory before they are written in one transaction
+TOUCH_BATCH = 256
+
+# Compute the key of a request
+# The images are hashed by their URLs, which contain the whole content for base64 encoded images.
+def CacheKey(ModelName: str, Prompt: str = "", ImageURLs: list = [], Temperature: float = 0.0, MaxTokens: int = 2048) -> str:
+    Hasher = hashlib.sha256()
+    Hasher.update(json.dumps([ModelName, Prompt, Temperature, MaxTokens], ensure_ascii=False).encode("utf-8"))
+    for ImageURL in ImageURLs:
+        Hasher.update(b"\0" + ImageURL.encode("utf-8"))
+
+    return Hasher.hexdigest()
+
+# Persistent cache of model responses
+# The cache can be shared by the threads of ConcurrentModelAPI, since all accesses are serialized by a lock.
+# MaxSize: The upper limit of the total size of the stored responses in bytes.
+# Hits / Misses: The counters of Get since the cache was opened.
+# Touched: The access times of the hits not written yet, which only affect the order of eviction,
+# so they are written in batches instead of one transaction per hit.
+class ResponseCache:
+    def __init__(self, CachePath: str = CACHE_FILE, MaxSize: int = 1073741824):
+        self.CachePath = CachePath
+        self.MaxSize = MaxSize
+        self.Lock = threading.Lock()
+        self.Hits = 0
+        self.Misses = 0
+        self.Touched = {}
+
+        self.Connection = sqlite3.connect(CachePath, check_same_thread=False)
+        # WAL mode keeps the database readable while another run is writing to it
+        self.Connection.execute("PRAGMA journal_mode=WAL")
+        self.Connection.execute(
+            "CREATE TABLE IF NOT EXISTS Responses (Key TEXT PRIMARY KEY, Result TEXT, Size INTEGER, AccessTime REAL)"
+        )
+        # Find the least recently used responses quickly when evicting
+        self.Connection.execute("CREATE INDEX IF NOT EXISTS ResponsesAccessTime ON Responses (AccessTime)")
+        self.Connection.commit()
+
+        self.Size = self.Connection.execute("SELECT COALESCE(SUM(Size), 0) FROM Responses").fetchone()[0]
+
+    # Get the cached response of a request, or None if it is not cached
+    def Get(self, Key: str) -> dict:
+        with self.Lock:
+            Row = self.Connection.execute("SELECT Result FROM Responses WHERE Key = ?", (Key,)).fetchone()
+            if Row is None:
+                self.Misses += 1
+                return None
+
+            self.Hits += 1
+            self.Touched[Key] = time.time()
+            if len(self.Touched) >= TOUCH_BATCH:
+                self.WriteTouched()
+                self.Connection.commit()
+
+        return json.loads(Row[0])
+
+    # Store the response of a request, evicting the least recently used responses if the cache is full
+    def Put(self, Key: str, Result: dict):
+        Data = json.dumps(Result, ensure_ascii=False)
+        Size = len(Data.encode("utf-8"))
+
+        with self.Lock:
+            self.Touched.pop(Key, None)
+            Row = self.Connection.execute("SELECT Size FROM Responses WHERE Key = ?", (Key,)).fetchone()
+            self.Connection.execute(
+                "INSERT OR REPLACE INTO Responses (Key, Result, Size, AccessTime) VALUES (?, ?, ?, ?)",
+                (Key, Data, Size, time.time())
+            )
+            self.Size += Size - (Row[0] if Row else 0)
+
+            if self.Size > self.MaxSize:
+                self.Evict()
+            self.Connection.commit()
+
+    # Write the access times of the recent hits, the lock must be held and the caller commits
+    def WriteTouched(self):
+        if self.Touched:
+            self.Connection.executemany(
+                "UPDATE Responses SET AccessTime = ? WHERE Key = ?",
+                [(AccessTime, Key) for Key, AccessTime in self.Touched.items()]
+            )
+            self.Touched.clear()
+
+    # Delete the least recently used responses until the cache fits in LOW_WATER of MaxSize, the lock must be held
+    # Only the rows to evict are read, and they are deleted by one statement.
+    def Evict(self):
+        self.WriteTouched()
+        Target = self.Size - int(self.MaxSize * LOW_WATER)
+        Evicted = Freed = 0
+        for (Size,) in self.Connection.execute("SELECT Size FROM Responses ORDER BY AccessTime"):
+            if Freed >= Target:
+                break
+            Freed += Size
+            Evicted += 1
+
+        self.Connection.execute(
+            "DELETE FROM Responses WHERE Key IN (SELECT Key FROM Responses ORDER BY AccessTime LIMIT ?)", (Evicted,)
+        )
+        self.Size -= Freed
+
+        LogMessage(f"Evicted {Evicted} responses from cache: {self.CachePath}", Type="INFO")
+
+    # Get the hit / miss counters and the size of the cache
+    def Stats(self) -> dict:
+        with self.Lock:
+            Entries = self.Connection.execute("SELECT COUNT(*) FROM Responses").fetchone()[0]
+
+        return {"Hits": self.Hits, "Misses": self.Misses, "Entries": Entries, "Size": self.Size}
+
+    # Write the pending access times and close the database connection
+    def Close(self):
+        with self.Lock:
+            self.WriteTouched()
+            self.Connection.commit()
+            self.Connection.close()